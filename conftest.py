@@ -3,6 +3,8 @@
 
 # (This file needs to be in or above the directory where py.test is called)
 
+from contextlib import contextmanager
+
 import pytest
 import os
 
@@ -41,3 +43,22 @@ def media_root(request):
         if not os.path.isdir(media_root):
             raise pytest.skip("Media unavailable")
     return media_root
+
+@pytest.fixture
+def count_queries():
+    """Returns a context manager that collects the SQL statements an engine
+    runs inside a `with` block, in the list it gives out.
+    """
+    from sqlalchemy import event
+
+    @contextmanager
+    def count_queries(engine):
+        queries = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return count_queries
@@ -1,22 +1,83 @@
 # encoding: utf-8
+import itertools
 import re
+import sqlite3
+import threading
 
-from sqlalchemy import engine_from_config, orm
+from sqlalchemy import create_engine, engine_from_config, event, orm, pool
+from sqlalchemy.engine.url import make_url
 
 from ..defaults import get_default_db_uri
 from .tables import Language, metadata
+from . import multilang
 from .multilang import MultilangSession, MultilangScopedSession
 
 ENGLISH_ID = 9
 
 
-def connect(uri=None, session_args={}, engine_args={}, engine_prefix=''):
-    """Connects to the requested URI.  Returns a session object.
+# Distinguishes the shared in-memory databases created by connect()
+_memory_database_ids = itertools.count()
 
-    With the URI omitted, attempts to connect to a default SQLite database
-    contained within the package directory.
-
-    Calling this function also binds the metadata object to the created engine.
+def _in_memory_sqlite_engine(uri, engine_args):
+    """Copies the SQLite database at `uri` into a shared in-memory database,
+    and returns a read-only engine for it.
+    """
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        raise ValueError("in_memory only works with SQLite database files")
+    # Both the backup API and URI filenames arrived by Python 3.7
+    if not hasattr(sqlite3.Connection, 'backup'):
+        raise RuntimeError("in_memory needs Python 3.7 or later")
+
+    # Every connection that opens this URI sees the same database, for as
+    # long as at least one of them stays open
+    memory_uri = 'file:pokedex-%d?mode=memory&cache=shared' % next(
+        _memory_database_ids)
+    def creator():
+        return sqlite3.connect(memory_uri, uri=True, check_same_thread=False)
+
+    master = creator()
+    source = sqlite3.connect(url.database)
+    try:
+        source.backup(master)
+    finally:
+        source.close()
+
+    all_engine_args = dict(creator=creator, poolclass=pool.QueuePool)
+    all_engine_args.update(engine_args)
+    engine = create_engine('sqlite://', **all_engine_args)
+
+    @event.listens_for(engine, 'connect')
+    def make_read_only(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA query_only = ON")
+
+    # Keep the master connection, and thus the database, alive with the engine
+    engine.memory_master_connection = master
+    # Every in-memory engine's URL is sqlite://; see multilang.database_identity
+    engine.pokedex_identity = memory_uri
+    return engine
+
+# Engines shared by every connect() in this process; see get_engine()
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_engine(uri=None, engine_args={}, engine_prefix='', in_memory=False,
+               pool_size=None, pool_pre_ping=False):
+    """Returns an engine for the requested URI, creating it the first time.
+
+    Engines are kept in a process-wide registry, so every `connect()` (and so
+    every `PokedexLookup`) for the same URI and arguments shares one engine
+    and its connection pool.
+
+    `pool_size`
+        Number of connections to keep open, for backends that pool them.
+        Ignored for SQLite files, which SQLAlchemy doesn't pool.
+
+    `pool_pre_ping`
+        Test each connection when it's taken from the pool, and reconnect if
+        it went stale, e.g. after a database server restart.
+
+    The other arguments are as for `connect()`.
     """
 
     # If we didn't get a uri, fall back to the default
@@ -43,13 +104,69 @@ def connect(uri=None, session_args={}, engine_args={}, engine_prefix=''):
         if 'auto_setinputsizes' not in uri:
             uri += '?auto_setinputsizes=FALSE'
 
-    ### Connect
-    engine_args[engine_prefix + 'url'] = uri
-    engine = engine_from_config(engine_args, prefix=engine_prefix)
-    conn = engine.connect()
+    engine_args = dict(
+        (key[len(engine_prefix):], value)
+        for key, value in engine_args.items()
+        if key.startswith(engine_prefix) and key != engine_prefix + 'url')
+    if pool_pre_ping:
+        engine_args['pool_pre_ping'] = True
+    if pool_size is not None and not (
+            make_url(uri).get_backend_name() == 'sqlite' and not in_memory):
+        engine_args['pool_size'] = pool_size
+
+    # Arguments may be unhashable (e.g. connect_args), so key on their repr
+    key = uri, in_memory, repr(sorted(engine_args.items()))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            if in_memory:
+                engine = _in_memory_sqlite_engine(uri, engine_args)
+            else:
+                engine_args['url'] = uri
+                engine = engine_from_config(engine_args, prefix='')
+            _engines[key] = engine
+    return engine
+
+def dispose_engines(uri=None):
+    """Closes the pooled connections of registered engines, and forgets the
+    engines.  With a `uri`, only engines for that URI are disposed.
+    """
+    with _engines_lock:
+        for key in list(_engines):
+            if uri is None or key[0] == uri:
+                _engines.pop(key).dispose()
+
+def connect(uri=None, session_args={}, engine_args={}, engine_prefix='',
+            in_memory=False, pool_size=None, pool_pre_ping=False,
+            cache_translations=False):
+    """Connects to the requested URI.  Returns a session object.
+
+    With the URI omitted, attempts to connect to a default SQLite database
+    contained within the package directory.
+
+    With `in_memory`, a SQLite database is copied into memory with SQLite's
+    backup API, and the returned session reads from that copy instead.  The
+    copy is read-only, and its connections can be shared among threads.
+    This needs Python 3.7 or later.
+
+    The engine comes from `get_engine()`, and is shared with other sessions
+    connected to the same URI; see there for `pool_size` and `pool_pre_ping`.
+
+    With `cache_translations`, the session reads names, prose and other
+    translated texts from the process-wide `multilang.translation_cache`
+    instead of querying for them.  Use it only for databases that won't change
+    while the process runs.
+
+    Calling this function also binds the metadata object to the created engine.
+    """
+
+    engine = get_engine(uri, engine_args, engine_prefix, in_memory=in_memory,
+                        pool_size=pool_size, pool_pre_ping=pool_pre_ping)
     metadata.bind = engine
 
     all_session_args = dict(autoflush=True, autocommit=False, bind=engine)
+    if cache_translations:
+        all_session_args['translation_cache'] = multilang.translation_cache
     all_session_args.update(session_args)
     sm = orm.sessionmaker(class_=MultilangSession,
         default_language_id=ENGLISH_ID, **all_session_args)
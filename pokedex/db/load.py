@@ -1,20 +1,32 @@
 """CSV to database or vice versa."""
 from __future__ import print_function
 
+import binascii
 import csv
+import errno
 import fnmatch
+import hashlib
 import io
+import itertools
 import os.path
+import shutil
 import sys
+import threading
+import time
 
 import six
+from six.moves import queue
+import sqlalchemy
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.schema
 import sqlalchemy.sql.util
 import sqlalchemy.types
+from sqlalchemy import Column, MetaData, Table, Unicode, orm
 
 import pokedex
-from pokedex.db import metadata, tables, translations
+from pokedex.db import markdown, metadata, multilang, tables, translations
 from pokedex.defaults import get_default_csv_dir
-from pokedex.db.dependencies import find_dependent_tables
+from pokedex.db.dependencies import compute_dependencies, find_dependent_tables
 from pokedex.db.oracle import rewrite_long_table_names
 
 
@@ -37,6 +49,111 @@ def _get_table_names(metadata, patterns):
 
     return list(table_names)
 
+#: Content hashes of the files each table was last loaded from.  Lives in its
+#: own metadata, so it's never dumped, documented, or dropped with the rest.
+manifest_metadata = MetaData()
+manifest_table = Table('pokedex_load_manifest', manifest_metadata,
+    Column('table_name', Unicode(64), primary_key=True),
+    Column('filename', Unicode(128), primary_key=True),
+    Column('content_hash', Unicode(40), nullable=False),
+)
+
+#: Manifest entry recording which languages' translations a table was loaded
+#: with, for tables with translations
+_LANGUAGES_MANIFEST_NAME = u'translations/:languages'
+
+def _hash_csv_files(table_objs, directory, engine, langs=None):
+    """Hashes the data each of the given tables is loaded from.
+
+    Returns a dict of table name => {filename: content hash}.  Every table
+    gets an entry for its own CSV file (missing files are left out), plus one
+    for its share of each translation file, if any.  Tables with translations
+    also get an entry for `langs`, as passed to `load()`, so that loading
+    other languages isn't mistaken for no change.
+    """
+    table_names = set(_csv_table_name(table, engine) for table in table_objs)
+    hashes = dict((name, {}) for name in table_names)
+
+    for table_name in table_names:
+        filename = table_name + '.csv'
+        try:
+            csvfile = open(os.path.join(directory, filename), 'rb')
+        except IOError:
+            continue
+        with csvfile:
+            hashes[table_name][filename] = hashlib.sha1(csvfile.read()).hexdigest()
+
+    # Translation files hold rows for lots of tables; hash each table's rows
+    # separately, so a new French move name doesn't reload every item
+    translation_dir = os.path.join(directory, 'translations')
+    if os.path.isdir(translation_dir):
+        for filename in sorted(os.listdir(translation_dir)):
+            if not filename.endswith('.csv'):
+                continue
+            manifest_name = 'translations/' + filename
+            section_hashes = {}
+            # CSV module only works with bytes on 2 and only works with text
+            # on 3!
+            path = os.path.join(translation_dir, filename)
+            if six.PY3:
+                csvfile = io.open(path, encoding='utf-8', newline='')
+            else:
+                csvfile = open(path, 'rb')
+            with csvfile:
+                reader = csv.reader(csvfile, lineterminator='\n')
+                next(reader, None)
+                for row in reader:
+                    # language_id, table, id, column, source_crc, string
+                    cls = translations.toplevel_class_by_name.get(row[1])
+                    translation_class = translations.translation_class_by_column.get(
+                        (cls, row[3]))
+                    if translation_class is None:
+                        continue
+                    table_name = _csv_table_name(translation_class.__table__, engine)
+                    if table_name not in table_names:
+                        continue
+                    if table_name not in section_hashes:
+                        section_hashes[table_name] = hashlib.sha1()
+                    line = '\x1f'.join(row) + '\n'
+                    if not isinstance(line, bytes):
+                        line = line.encode('utf-8')
+                    section_hashes[table_name].update(line)
+            for table_name, section_hash in section_hashes.items():
+                hashes[table_name][manifest_name] = section_hash.hexdigest()
+
+    if langs is None:
+        languages = u'*'
+    else:
+        languages = u','.join(sorted(set(langs)))
+    languages_hash = hashlib.sha1(languages.encode('utf-8')).hexdigest()
+    for file_hashes in hashes.values():
+        if any(filename.startswith('translations/') for filename in file_hashes):
+            file_hashes[_LANGUAGES_MANIFEST_NAME] = languages_hash
+
+    return hashes
+
+def _read_manifest(connection):
+    """Returns the stored manifest, in the same form `_hash_csv_files` uses.
+    """
+    manifest_table.create(bind=connection, checkfirst=True)
+    hashes = {}
+    for row in connection.execute(manifest_table.select()):
+        hashes.setdefault(row.table_name, {})[row.filename] = row.content_hash
+    return hashes
+
+def _write_manifest(connection, hashes):
+    """Replaces the stored hashes of the tables in `hashes`."""
+    manifest_table.create(bind=connection, checkfirst=True)
+    connection.execute(manifest_table.delete().where(
+        manifest_table.c.table_name.in_(list(hashes))))
+    rows = [
+        dict(table_name=table_name, filename=filename, content_hash=content_hash)
+        for table_name, file_hashes in hashes.items()
+        for filename, content_hash in file_hashes.items()
+    ]
+    if rows:
+        connection.execute(manifest_table.insert(), rows)
+
 def _get_verbose_prints(verbose):
     """If `verbose` is true, returns three functions: one for printing a
     starting message, one for printing an interim status update, and one for
@@ -100,7 +217,452 @@ def _get_verbose_prints(verbose):
     return print_start, print_status, print_done
 
 
-def load(session, tables=[], directory=None, drop_tables=False, verbose=False, safe=True, recursive=True, langs=None):
+def _run_in_dependency_order(table_objs, func, workers, graph=None):
+    """Calls `func(table)` for every table in `table_objs`, spread over a pool
+    of `workers` threads.
+
+    A table is only handed to a worker once every table it depends on (as
+    reported by `compute_dependencies`, or given in `graph`) has been
+    processed.  Tables are otherwise started in the order given.
+
+    Returns a dict of table => whatever `func` returned for it.  If `func`
+    raises, no new tables are started and the exception is re-raised once the
+    tables already in progress are finished.
+    """
+    if graph is None:
+        graph = compute_dependencies(table_objs)
+
+    # table => set of tables it is still waiting for
+    waiting_on = dict((table, set()) for table in table_objs)
+    for parent, children in graph.items():
+        for child in children:
+            if child in waiting_on and child is not parent:
+                waiting_on[child].add(parent)
+
+    ready = queue.Queue()
+    finished = queue.Queue()
+
+    def worker():
+        while True:
+            table = ready.get()
+            if table is None:
+                return
+            try:
+                finished.put((table, func(table), None))
+            except BaseException:
+                finished.put((table, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=worker) for n in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    results = {}
+    in_progress = 0
+    try:
+        for table in table_objs:
+            if not waiting_on[table]:
+                ready.put(table)
+                in_progress += 1
+
+        while len(results) < len(table_objs):
+            if not in_progress:
+                raise ValueError("Circular dependency between tables: " +
+                    ', '.join(t.name for t in table_objs if t not in results))
+
+            table, result, exc_info = finished.get()
+            in_progress -= 1
+            if exc_info:
+                six.reraise(*exc_info)
+            results[table] = result
+
+            for child in graph.get(table, ()):
+                parents = waiting_on.get(child)
+                if parents and table in parents:
+                    parents.discard(table)
+                    if not parents:
+                        ready.put(child)
+                        in_progress += 1
+    finally:
+        for thread in threads:
+            ready.put(None)
+        for thread in threads:
+            thread.join()
+
+    return results
+
+def _run_in_worker_sessions(engine, table_objs, func, workers, print_start,
+                            print_done, in_dependency_order=True):
+    """Calls `func(session, table)` for every table in `table_objs`, spread
+    over a pool of `workers` threads as by `_run_in_dependency_order`.  Every
+    worker thread gets a session, and thus a connection, of its own.
+
+    `func` returns a `(result, status message)` pair.  Tables finish in
+    whatever order, so each one's name and status are printed as a whole
+    line once it's done.  Unless `in_dependency_order` is true, tables are
+    started without waiting for the ones they depend on.
+
+    Returns a dict of table => result.
+    """
+    worker_session = orm.scoped_session(orm.sessionmaker(bind=engine))
+    print_lock = threading.Lock()
+
+    def run_one(table):
+        try:
+            result, status = func(worker_session(), table)
+        finally:
+            worker_session.remove()
+
+        with print_lock:
+            print_start(_csv_table_name(table, engine))
+            print_done(status)
+        return result
+
+    if in_dependency_order:
+        graph = None
+    else:
+        graph = {}
+    return _run_in_dependency_order(table_objs, run_one, workers, graph=graph)
+
+def _critical_path(table_objs, timings):
+    """Finds the chain of dependent tables that took the longest to load in
+    total, given a dict of table => seconds.
+
+    Returns `(total_seconds, [table, ...])`.
+    """
+    graph = compute_dependencies(table_objs)
+    parents = dict((table, []) for table in table_objs)
+    for parent, children in graph.items():
+        for child in children:
+            if child in parents and child is not parent:
+                parents[child].append(parent)
+
+    # Tables are sorted by dependency, so parents are always seen first
+    best = {}
+    for table in table_objs:
+        elapsed = timings.get(table, 0)
+        candidates = [best[parent] for parent in parents[table]]
+        if candidates:
+            parent_total, parent_path = max(candidates, key=lambda c: c[0])
+            best[table] = parent_total + elapsed, parent_path + [table]
+        else:
+            best[table] = elapsed, [table]
+
+    if not best:
+        return 0, []
+    return max(best.values(), key=lambda c: c[0])
+
+def _csv_table_name(table_obj, engine):
+    """Returns the name of the CSV file (sans extension) for a table."""
+    if engine.dialect.name == 'oracle':
+        return table_obj._original_name
+    else:
+        return table_obj.name
+
+def _make_row_converter(table_obj, column_names, as_tuple=False):
+    """Returns a function that turns a CSV row (a list of strings) into a dict
+    of values ready to be bound to `table_obj`'s INSERT.  With `as_tuple`, it
+    returns a tuple in the order of `column_names` instead, for the DB-API.
+
+    All of the per-column decisions are made once, up front, so that loading
+    a row is just a matter of calling one small function per cell.
+    """
+    converters = []
+    for column_name in column_names:
+        column = table_obj.c[column_name]
+
+        if isinstance(column.type, sqlalchemy.types.Boolean):
+            # Boolean values are stored as string values 0/1, but both of
+            # those evaluate as true; SQLA wants True/False
+            convert = _convert_boolean
+        elif isinstance(column.type, sqlalchemy.types.Integer):
+            convert = int
+        elif six.PY2:
+            # Otherwise, unflatten from bytes
+            convert = _convert_text
+        else:
+            convert = None
+
+        if column.nullable:
+            # Empty string in a nullable column really means NULL
+            convert = _nullable_converter(convert)
+
+        converters.append(convert or _convert_identity)
+
+    # nb: Dictionaries flattened with ** have to have string keys
+    keys = [str(column_name) for column_name in column_names]
+
+    if as_tuple:
+        def convert_row(csvs):
+            return tuple([convert(value)
+                          for convert, value in zip(converters, csvs)])
+    else:
+        def convert_row(csvs):
+            return dict(zip(keys, [convert(value)
+                                   for convert, value in zip(converters, csvs)]))
+
+    return convert_row
+
+def _copy_postgresql(session, table_obj, csvfile, column_names, csvsize, print_status):
+    """Loads a CSV file with Postgres' COPY FROM STDIN."""
+    engine = session.get_bind()
+
+    # Postgres' CSV dialect works with our data, if we mark the not-null
+    # columns with FORCE NOT NULL.
+    not_null_cols = [c for c in column_names if not table_obj.c[c].nullable]
+    if not_null_cols:
+        force_not_null = 'FORCE NOT NULL ' + ','.join('"%s"' % c for c in not_null_cols)
+    else:
+        force_not_null = ''
+
+    # Grab the underlying psycopg2 cursor so we can use COPY FROM STDIN
+    raw_conn = engine.raw_connection()
+    command = "COPY %(table_name)s (%(columns)s) FROM STDIN CSV HEADER %(force_not_null)s"
+    raw_conn.cursor().copy_expert(
+        command % dict(
+            table_name=table_obj.name,
+            columns=','.join('"%s"' % c for c in column_names),
+            force_not_null=force_not_null,
+        ),
+        csvfile,
+    )
+    raw_conn.commit()
+
+def _executemany_sqlite(session, table_obj, csvfile, column_names, csvsize, print_status):
+    """Loads a CSV file by feeding one prepared INSERT to the DB-API's
+    executemany(), all in a single transaction.
+    """
+    engine = session.get_bind()
+    preparer = engine.dialect.identifier_preparer
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (
+        preparer.format_table(table_obj),
+        ', '.join(preparer.quote(c) for c in column_names),
+        ', '.join('?' for c in column_names),
+    )
+
+    reader = csv.reader(csvfile, lineterminator='\n')
+    next(reader)
+    convert_row = _make_row_converter(table_obj, column_names, as_tuple=True)
+    rows = (convert_row(csvs) for csvs in reader)
+
+    # SQLite doesn't check foreign keys unless asked to, so unlike load()'s
+    # usual path, self-referential rows can go in in any order
+    cursor = session.connection().connection.cursor()
+    csvpos = 0
+    while True:
+        chunk = list(itertools.islice(rows, 1000))
+        if not chunk:
+            break
+        cursor.executemany(statement, chunk)
+
+        csvpos += len(chunk)
+        print_status("%d%%" % (100 * csvpos // csvsize))
+    session.commit()
+
+def _load_data_mysql(session, table_obj, csvfile, column_names, csvsize, print_status):
+    """Loads a CSV file with MySQL's LOAD DATA LOCAL INFILE."""
+    engine = session.get_bind()
+    preparer = engine.dialect.identifier_preparer
+
+    # Empty strings in nullable columns mean NULL; LOAD DATA needs to be
+    # told so column by column
+    targets = []
+    assignments = []
+    for n, column_name in enumerate(column_names):
+        if table_obj.c[column_name].nullable:
+            targets.append('@v%d' % n)
+            assignments.append("%s = NULLIF(@v%d, '')" % (
+                preparer.quote(column_name), n))
+        else:
+            targets.append(preparer.quote(column_name))
+
+    command = (
+        "LOAD DATA LOCAL INFILE %%s INTO TABLE %s CHARACTER SET utf8 "
+        "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+        "LINES TERMINATED BY '\\n' IGNORE 1 LINES (%s)"
+    ) % (preparer.format_table(table_obj), ', '.join(targets))
+    if assignments:
+        command += " SET " + ', '.join(assignments)
+
+    # LOCAL INFILE is off unless it's asked for when connecting, so this
+    # needs a connection of its own
+    args, kwargs = engine.dialect.create_connect_args(engine.url)
+    kwargs['local_infile'] = 1
+    raw_conn = engine.dialect.dbapi.connect(*args, **kwargs)
+    try:
+        cursor = raw_conn.cursor()
+        # Self-referential rows may refer to rows further down the file
+        cursor.execute("SET foreign_key_checks = 0")
+        cursor.execute(command, (os.path.abspath(csvfile.name),))
+        raw_conn.commit()
+    finally:
+        raw_conn.close()
+
+#: Dialect name => function that loads a whole CSV file in one go.  Used
+#: unless load() is asked to be safe.
+_bulk_loaders = dict(
+    postgresql=_copy_postgresql,
+    sqlite=_executemany_sqlite,
+    mysql=_load_data_mysql,
+)
+
+def _convert_boolean(value):
+    return value != '0'
+
+def _convert_text(value):
+    return value.decode('utf-8')
+
+def _convert_identity(value):
+    return value
+
+def _nullable_converter(convert):
+    """Wraps a converter so that it turns empty strings into None."""
+    if convert is None:
+        def convert_nullable(value):
+            if value == '':
+                return None
+            return value
+    else:
+        def convert_nullable(value):
+            if value == '':
+                return None
+            return convert(value)
+    return convert_nullable
+
+def _create_bare_table(table, bind, with_foreign_keys=True):
+    """Creates a table without any indexes, and optionally without foreign
+    keys, so they don't have to be maintained while loading.
+    """
+    # Types like Postgres' enums have to exist before the table does;
+    # table.create() would take care of that
+    for column in table.c:
+        try:
+            create = column.type.create
+        except AttributeError:
+            pass
+        else:
+            create(bind=bind, checkfirst=True)
+
+    if with_foreign_keys:
+        include_foreign_key_constraints = None
+    else:
+        include_foreign_key_constraints = []
+    bind.execute(sqlalchemy.schema.CreateTable(table,
+        include_foreign_key_constraints=include_foreign_key_constraints))
+
+def _load_table(session, table_obj, directory, safe, print_status):
+    """Loads a single table's CSV file using the given session.
+
+    Returns a short status message: 'ok', or 'missing?' if there is no CSV
+    file for the table.
+    """
+    engine = session.get_bind()
+    table_name = _csv_table_name(table_obj, engine)
+
+    insert_stmt = table_obj.insert()
+
+    try:
+        csvpath = "%s/%s.csv" % (directory, table_name)
+        csvfile = open(csvpath, 'r')
+    except IOError:
+        # File doesn't exist; don't load anything!
+        return 'missing?'
+
+    # XXX This is wrong for files with multi-line fields, but Python 3
+    # doesn't allow .tell() on a file that's currently being iterated
+    # (because the result is completely bogus).  Oh well.
+    csvsize = sum(1 for line in csvfile)
+    csvfile.seek(0)
+
+    reader = csv.reader(csvfile, lineterminator='\n')
+    column_names = [six.text_type(column) for column in next(reader)]
+
+    if not safe and engine.dialect.name in _bulk_loaders:
+        csvfile.seek(0)
+        _bulk_loaders[engine.dialect.name](
+            session, table_obj, csvfile, column_names, csvsize, print_status)
+        return 'ok'
+
+    # Self-referential tables may contain rows with foreign keys of other
+    # rows in the same table that do not yet exist.  Pull these out and
+    # insert them last
+    # ASSUMPTION: Self-referential tables have a single PK called "id"
+    deferred_rows = []  # ( row referring to id, [foreign ids we need] )
+    seen_ids = set()    # primary keys we've seen
+
+    # Fetch foreign key columns that point at this table, if any
+    self_ref_columns = []
+    for column in table_obj.c:
+        if any(x.references(table_obj) for x in column.foreign_keys):
+            self_ref_columns.append(column)
+
+    new_rows = []
+    def insert_and_commit():
+        if not new_rows:
+            return
+        session.execute(insert_stmt, new_rows)
+        session.commit()
+        new_rows[:] = []
+
+        progress = "%d%%" % (100 * csvpos // csvsize)
+        print_status(progress)
+
+    convert_row = _make_row_converter(table_obj, column_names)
+
+    csvpos = 0
+    for csvs in reader:
+        csvpos += 1
+        row_data = convert_row(csvs)
+
+        # May need to stash this row and add it later if it refers to a
+        # later row in this table
+        if self_ref_columns:
+            foreign_ids = set(row_data[x.name] for x in self_ref_columns)
+            foreign_ids.discard(None)  # remove NULL ids
+
+            if not foreign_ids:
+                # NULL key.  Remember this row and add as usual.
+                seen_ids.add(row_data['id'])
+
+            elif foreign_ids.issubset(seen_ids):
+                # Non-NULL key we've already seen.  Remember it and commit
+                # so we know the old row exists when we add the new one
+                insert_and_commit()
+                seen_ids.add(row_data['id'])
+
+            else:
+                # Non-NULL future id.  Save this and insert it later!
+                deferred_rows.append((row_data, foreign_ids))
+                continue
+
+        # Insert row!
+        new_rows.append(row_data)
+
+        # Remembering some zillion rows in the session consumes a lot of
+        # RAM.  Let's not do that.  Commit every 1000 rows
+        if len(new_rows) >= 1000:
+            insert_and_commit()
+
+    insert_and_commit()
+
+    # Attempt to add any spare rows we've collected
+    for row_data, foreign_ids in deferred_rows:
+        if not foreign_ids.issubset(seen_ids):
+            # Could happen if row A refers to B which refers to C.
+            # This is ridiculous and doesn't happen in my data so far
+            raise ValueError("Too many levels of self-reference!  "
+                             "Row was: " + str(row_data))
+
+        session.execute(
+            insert_stmt.values(**row_data)
+        )
+        seen_ids.add(row_data['id'])
+
+    session.commit()
+    return 'ok'
+
+
+def load(session, tables=[], directory=None, drop_tables=False, verbose=False, safe=True, recursive=True, langs=None, workers=1, incremental=False, defer_indexes=None):
     """Load data from CSV files into the given database session.
 
     Tables are created automatically.
@@ -123,13 +685,36 @@ def load(session, tables=[], directory=None, drop_tables=False, verbose=False, s
 
     `safe`
         If set to False, load can be faster, but can corrupt the database if
-        it crashes or is interrupted.
+        it crashes or is interrupted.  Tables are then bulk-loaded in a
+        database-specific way: COPY on PostgreSQL, LOAD DATA LOCAL INFILE on
+        MySQL, and one big executemany() per table on SQLite.
 
     `recursive`
         If set to True, load all dependent tables too.
 
     `langs`
         List of identifiers of extra language to load, or None to load them all
+
+    `workers`
+        Number of tables to load at the same time, each over its own
+        connection.  A table is only loaded once all the tables it refers to
+        are done.  SQLite can only handle one writer at a time, so this is
+        ignored there.
+
+    `incremental`
+        If set to True, only tables whose CSV files (or translations, or
+        `langs`) changed since they were last loaded are dropped and reloaded,
+        along with every table that depends on them.  Everything else is left alone.  The
+        hashes this relies on are kept in the `pokedex_load_manifest` table.
+        Once a database has that table, every load keeps it up to date;
+        loads into a database without it don't hash anything.
+
+    `defer_indexes`
+        If set to True, tables are created bare, and their indexes and
+        foreign keys are only added once all the data (translations
+        included) is in.  SQLite can't add foreign keys to an existing
+        table, so it only defers indexes.  Defaults to True for unsafe loads
+        into SQLite, and False otherwise.
     """
 
     # First take care of verbosity
@@ -160,8 +745,47 @@ def load(session, tables=[], directory=None, drop_tables=False, verbose=False, s
         session.execute("PRAGMA synchronous=OFF")
         session.execute("PRAGMA journal_mode=OFF")
 
+    # Hashing every file takes a while; only bother for databases that keep
+    # a manifest
+    keep_manifest = incremental or manifest_table.exists(bind=engine)
+    if keep_manifest:
+        csv_hashes = _hash_csv_files(table_objs, directory, engine, langs)
+    if incremental:
+        print_start('Comparing with manifest')
+        old_hashes = _read_manifest(session.connection())
+        session.commit()
+        changed_tables = set(
+            table for table in table_objs
+            if csv_hashes[_csv_table_name(table, engine)] !=
+                    old_hashes.get(_csv_table_name(table, engine), {})
+                or not table.exists(bind=engine)
+        )
+        # Dependents have to be dropped and reloaded too, whether they were
+        # asked for or not
+        changed_tables.update(find_dependent_tables(changed_tables))
+        print_done('%s changed, %s unchanged' % (
+            len(changed_tables), len(set(table_objs) - changed_tables)))
+
+        table_objs = sqlalchemy.sql.util.sort_tables(changed_tables)
+        csv_hashes.update(_hash_csv_files(
+            [table for table in changed_tables
+             if _csv_table_name(table, engine) not in csv_hashes],
+            directory, engine, langs))
+        drop_tables = True
+        if not table_objs:
+            return
+
+    # SQLite locks the whole database for writing, and every connection to an
+    # in-memory database gets a brand new database; don't even try
+    if engine.dialect.name == 'sqlite':
+        workers = 1
+
+    # (phase, seconds) for the summary at the end
+    phase_times = []
+
     # Drop all tables if requested
     if drop_tables:
+        phase_started = time.time()
         print_start('Dropping tables')
         for n, table in enumerate(reversed(table_objs)):
             table.drop(bind=engine, checkfirst=True)
@@ -178,162 +802,52 @@ def load(session, tables=[], directory=None, drop_tables=False, verbose=False, s
 
             print_status('%s/%s' % (n, len(table_objs)))
         print_done()
+        phase_times.append(('drop', time.time() - phase_started))
 
+    # SQLite's bulk path is much faster if it doesn't have to keep indexes
+    # up to date along the way
+    if defer_indexes is None:
+        defer_indexes = not safe and engine.dialect.name == 'sqlite'
+    defer_foreign_keys = defer_indexes and engine.dialect.supports_alter
+
+    phase_started = time.time()
     print_start('Creating tables')
     for n, table in enumerate(table_objs):
-        table.create()
+        if defer_indexes:
+            _create_bare_table(table, engine, with_foreign_keys=not defer_foreign_keys)
+        else:
+            table.create(bind=engine)
         print_status('%s/%s' % (n, len(table_objs)))
     print_done()
+    phase_times.append(('create', time.time() - phase_started))
 
     # Okay, run through the tables and actually load the data now
-    for table_obj in table_objs:
-        if oracle:
-            table_name = table_obj._original_name
-        else:
-            table_name = table_obj.name
-
-        insert_stmt = table_obj.insert()
-
-        print_start(table_name)
-
-        try:
-            csvpath = "%s/%s.csv" % (directory, table_name)
-            csvfile = open(csvpath, 'r')
-        except IOError:
-            # File doesn't exist; don't load anything!
-            print_done('missing?')
-            continue
-
-        # XXX This is wrong for files with multi-line fields, but Python 3
-        # doesn't allow .tell() on a file that's currently being iterated
-        # (because the result is completely bogus).  Oh well.
-        csvsize = sum(1 for line in csvfile)
-        csvfile.seek(0)
-
-        reader = csv.reader(csvfile, lineterminator='\n')
-        column_names = [six.text_type(column) for column in next(reader)]
-
-        if not safe and engine.dialect.name == 'postgresql':
-            # Postgres' CSV dialect works with our data, if we mark the not-null
-            # columns with FORCE NOT NULL.
-            not_null_cols = [c for c in column_names if not table_obj.c[c].nullable]
-            if not_null_cols:
-                force_not_null = 'FORCE NOT NULL ' + ','.join('"%s"' % c for c in not_null_cols)
-            else:
-                force_not_null = ''
-
-            # Grab the underlying psycopg2 cursor so we can use COPY FROM STDIN
-            raw_conn = engine.raw_connection()
-            command = "COPY %(table_name)s (%(columns)s) FROM STDIN CSV HEADER %(force_not_null)s"
-            csvfile.seek(0)
-            raw_conn.cursor().copy_expert(
-                command % dict(
-                    table_name=table_name,
-                    columns=','.join('"%s"' % c for c in column_names),
-                    force_not_null=force_not_null,
-                ),
-                csvfile,
-            )
-            raw_conn.commit()
-            print_done()
-            continue
-
-        # Self-referential tables may contain rows with foreign keys of other
-        # rows in the same table that do not yet exist.  Pull these out and
-        # insert them last
-        # ASSUMPTION: Self-referential tables have a single PK called "id"
-        deferred_rows = []  # ( row referring to id, [foreign ids we need] )
-        seen_ids = set()    # primary keys we've seen
-
-        # Fetch foreign key columns that point at this table, if any
-        self_ref_columns = []
-        for column in table_obj.c:
-            if any(x.references(table_obj) for x in column.foreign_keys):
-                self_ref_columns.append(column)
-
-        new_rows = []
-        def insert_and_commit():
-            if not new_rows:
-                return
-            session.execute(insert_stmt, new_rows)
-            session.commit()
-            new_rows[:] = []
-
-            progress = "%d%%" % (100 * csvpos // csvsize)
-            print_status(progress)
-
-        csvpos = 0
-        for csvs in reader:
-            csvpos += 1
-            row_data = {}
-
-            for column_name, value in zip(column_names, csvs):
-                column = table_obj.c[column_name]
-                if column.nullable and value == '':
-                    # Empty string in a nullable column really means NULL
-                    value = None
-                elif isinstance(column.type, sqlalchemy.types.Boolean):
-                    # Boolean values are stored as string values 0/1, but both
-                    # of those evaluate as true; SQLA wants True/False
-                    if value == '0':
-                        value = False
-                    else:
-                        value = True
-                elif isinstance(value, bytes):
-                    # Otherwise, unflatten from bytes
-                    value = value.decode('utf-8')
-
-                # nb: Dictionaries flattened with ** have to have string keys
-                row_data[ str(column_name) ] = value
-
-            # May need to stash this row and add it later if it refers to a
-            # later row in this table
-            if self_ref_columns:
-                foreign_ids = set(row_data[x.name] for x in self_ref_columns)
-                foreign_ids.discard(None)  # remove NULL ids
-
-                if not foreign_ids:
-                    # NULL key.  Remember this row and add as usual.
-                    seen_ids.add(row_data['id'])
-
-                elif foreign_ids.issubset(seen_ids):
-                    # Non-NULL key we've already seen.  Remember it and commit
-                    # so we know the old row exists when we add the new one
-                    insert_and_commit()
-                    seen_ids.add(row_data['id'])
-
-                else:
-                    # Non-NULL future id.  Save this and insert it later!
-                    deferred_rows.append((row_data, foreign_ids))
-                    continue
-
-            # Insert row!
-            new_rows.append(row_data)
-
-            # Remembering some zillion rows in the session consumes a lot of
-            # RAM.  Let's not do that.  Commit every 1000 rows
-            if len(new_rows) >= 1000:
-                insert_and_commit()
-
-        insert_and_commit()
-
-        # Attempt to add any spare rows we've collected
-        for row_data, foreign_ids in deferred_rows:
-            if not foreign_ids.issubset(seen_ids):
-                # Could happen if row A refers to B which refers to C.
-                # This is ridiculous and doesn't happen in my data so far
-                raise ValueError("Too many levels of self-reference!  "
-                                 "Row was: " + str(row))
-
-            session.execute(
-                insert_stmt.values(**row_data)
-            )
-            seen_ids.add(row_data['id'])
-
-        session.commit()
-        print_done()
-
-
+    phase_started = time.time()
+    if workers > 1:
+        timings = {}
+
+        def load_one(worker_session, table_obj):
+            start_time = time.time()
+            status = _load_table(worker_session, table_obj, directory, safe,
+                                 lambda msg: None)
+            timings[table_obj] = time.time() - start_time
+            return status, '%s %.1fs' % (status, timings[table_obj])
+
+        _run_in_worker_sessions(engine, table_objs, load_one, workers,
+                                print_start, print_done)
+
+        total_time, path = _critical_path(table_objs, timings)
+        print_start('Critical path: %.1fs' % total_time)
+        print_done(' -> '.join(table.name for table in path))
+    else:
+        for table_obj in table_objs:
+            print_start(_csv_table_name(table_obj, engine))
+            status = _load_table(session, table_obj, directory, safe,
+                                 print_status)
+            print_done(status)
+    phase_times.append(('data', time.time() - phase_started))
+
+    phase_started = time.time()
     print_start('Translations')
     transl = translations.Translations(csv_directory=directory)
 
@@ -348,14 +862,159 @@ def load(session, tables=[], directory=None, drop_tables=False, verbose=False, s
             new_row_count += len(rows)
             print_status(str(new_row_count))
 
+    print_done()
+    phase_times.append(('translations', time.time() - phase_started))
+
+    if defer_indexes:
+        phase_started = time.time()
+        print_start('Creating indexes')
+        for n, table in enumerate(table_objs):
+            for index in table.indexes:
+                index.create(bind=engine)
+            print_status('%s/%s' % (n, len(table_objs)))
+        print_done()
+        phase_times.append(('indexes', time.time() - phase_started))
+
+    if defer_foreign_keys:
+        phase_started = time.time()
+        print_start('Adding foreign keys')
+        for n, table in enumerate(table_objs):
+            for constraint in table.foreign_key_constraints:
+                engine.execute(sqlalchemy.schema.AddConstraint(constraint))
+            print_status('%s/%s' % (n, len(table_objs)))
+        print_done()
+        phase_times.append(('foreign keys', time.time() - phase_started))
+
     # SQLite check
     if engine.dialect.name == 'sqlite':
+        phase_started = time.time()
+        print_start('Checking integrity')
         session.execute("PRAGMA integrity_check")
+        print_done()
+        phase_times.append(('integrity check', time.time() - phase_started))
 
-    print_done()
+    # Remember what we just loaded, for the next incremental load
+    if keep_manifest:
+        _write_manifest(session.connection(), dict(
+            (_csv_table_name(table, engine), csv_hashes[_csv_table_name(table, engine)])
+            for table in table_objs))
+        session.commit()
+    multilang.translation_cache.clear()
+    markdown.html_cache.clear()
+
+    print_start('Timings')
+    print_done(', '.join('%s %.1fs' % phase_time for phase_time in phase_times))
 
 
-def dump(session, tables=[], directory=None, verbose=False, langs=None):
+def _create_temp_file(filename):
+    """Creates an empty file next to `filename`, to be renamed over it once
+    written.  Returns `(file descriptor, temporary filename)`.
+
+    Unlike mkstemp(), which makes private files, this gives the file the
+    permissions `filename` already has, or if it doesn't exist yet, the ones
+    the umask gives any new file.
+    """
+    directory, basename = os.path.split(filename)
+    while True:
+        temp_filename = os.path.join(directory, '.%s.%s.tmp' % (
+            basename, binascii.hexlify(os.urandom(4)).decode('ascii')))
+        try:
+            fd = os.open(temp_filename,
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        break
+
+    if os.path.exists(filename):
+        shutil.copymode(filename, temp_filename)
+    return fd, temp_filename
+
+def _dump_table(connection, table, filename, language_ids=None):
+    """Dumps a single table to the named CSV file, through the given
+    connection.
+
+    The file is written under a temporary name and renamed into place once
+    it's complete, so it's never left half-written.  If `language_ids` is
+    given, only rows in those languages are dumped.
+
+    Returns `(number of rows, number of bytes)` written.
+    """
+    # CSV module only works with bytes on 2 and only works with text on 3!
+    if six.PY3:
+        columns = [col.name for col in table.columns]
+    else:
+        columns = [col.name.encode('utf8') for col in table.columns]
+
+    query = sqlalchemy.sql.select([table]).order_by(*table.primary_key)
+    if language_ids is not None:
+        if language_ids:
+            query = query.where(table.c.local_language_id.in_(language_ids))
+        else:
+            query = query.where(sqlalchemy.sql.false())
+
+    fd, temp_filename = _create_temp_file(filename)
+    try:
+        if six.PY3:
+            csvfile = io.open(fd, 'w', encoding='utf-8', newline='')
+        else:
+            csvfile = os.fdopen(fd, 'wb')
+    except BaseException:
+        # Nothing owns the descriptor yet
+        os.close(fd)
+        os.remove(temp_filename)
+        raise
+
+    try:
+        row_count = 0
+        with csvfile:
+            writer = csv.writer(csvfile, lineterminator='\n')
+            writer.writerow(columns)
+
+            # Stream the rows through in chunks, rather than loading whole
+            # tables; where the driver can, use a server-side cursor
+            result = connection.execution_options(
+                stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(1000)
+                if not rows:
+                    break
+
+                for row in rows:
+                    csvs = []
+                    for val in row:
+                        # Convert Pythony values to something more universal
+                        if val == None:
+                            val = ''
+                        elif val == True:
+                            val = '1'
+                        elif val == False:
+                            val = '0'
+                        else:
+                            val = six.text_type(val)
+                            if not six.PY3:
+                                val = val.encode('utf8')
+
+                        csvs.append(val)
+
+                    writer.writerow(csvs)
+                row_count += len(rows)
+
+        _replace_file(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+    return row_count, os.path.getsize(filename)
+
+try:
+    _replace_file = os.replace
+except AttributeError:
+    # Python 2; rename() is still atomic on POSIX
+    _replace_file = os.rename
+
+def dump(session, tables=[], directory=None, verbose=False, langs=None, workers=1):
     """Dumps the contents of a database to a set of CSV files.  Probably not
     useful to anyone besides a developer.
 
@@ -374,6 +1033,15 @@ def dump(session, tables=[], directory=None, verbose=False, langs=None):
 
     `langs`
         List of identifiers of languages to dump unofficial texts for
+
+    `workers`
+        Number of tables to dump at the same time, each over its own
+        connection.
+
+    Each file is written to a temporary file first and renamed into place,
+    so an interrupted dump leaves every CSV file either old or new.
+
+    Returns a dict of table name => (number of rows, number of bytes).
     """
 
     # First take care of verbosity
@@ -387,71 +1055,168 @@ def dump(session, tables=[], directory=None, verbose=False, langs=None):
     table_names = _get_table_names(metadata, tables)
     table_names.sort()
 
+    engine = session.get_bind()
+
     # Oracle needs to dump from tables with shortened names to csvs with the
     # usual names
-    oracle = (session.connection().dialect.name == 'oracle')
+    oracle = (engine.dialect.name == 'oracle')
     if oracle:
         rewrite_long_table_names()
 
-    for table_name in table_names:
-        print_start(table_name)
-        table = metadata.tables[table_name]
-
-        if oracle:
-            filename = '%s/%s.csv' % (directory, table._original_name)
-        else:
-            filename = '%s/%s.csv' % (directory, table_name)
-
-        # CSV module only works with bytes on 2 and only works with text on 3!
-        if six.PY3:
-            writer = csv.writer(open(filename, 'w', newline=''), lineterminator='\n')
-            columns = [col.name for col in table.columns]
-        else:
-            writer = csv.writer(open(filename, 'wb'), lineterminator='\n')
-            columns = [col.name.encode('utf8') for col in table.columns]
+    # Every connection to an in-memory SQLite database sees a different one
+    if engine.dialect.name == 'sqlite' and engine.url.database in (None, '', ':memory:'):
+        workers = 1
 
+    def language_ids_for(table):
         # For name tables, always dump rows for official languages, as well as
         # for those in `langs` if specified.
         # For other translation tables, only dump rows for languages in `langs`
         # if specified, or for official languages by default.
         # For non-translation tables, dump all rows.
-        if 'local_language_id' in columns:
-            if langs is None:
-                def include_row(row):
-                    return languages[row.local_language_id].official
-            elif any(col.info.get('official') for col in table.columns):
-                def include_row(row):
-                    return (languages[row.local_language_id].official or
-                            languages[row.local_language_id].identifier in langs)
-            else:
-                def include_row(row):
-                    return languages[row.local_language_id].identifier in langs
+        if 'local_language_id' not in table.c:
+            return None
+        elif langs is None:
+            def include_language(language):
+                return language.official
+        elif any(col.info.get('official') for col in table.columns):
+            def include_language(language):
+                return language.official or language.identifier in langs
         else:
-            def include_row(row):
-                return True
-
-        writer.writerow(columns)
-
-        primary_key = table.primary_key
-        for row in session.query(table).order_by(*primary_key).all():
-            if include_row(row):
-                csvs = []
-                for col in columns:
-                    # Convert Pythony values to something more universal
-                    val = getattr(row, col)
-                    if val == None:
-                        val = ''
-                    elif val == True:
-                        val = '1'
-                    elif val == False:
-                        val = '0'
-                    else:
-                        val = six.text_type(val)
-                        if not six.PY3:
-                            val = val.encode('utf8')
-
-                    csvs.append(val)
-
-                writer.writerow(csvs)
+            def include_language(language):
+                return language.identifier in langs
+
+        return [id for id, language in sorted(languages.items())
+                if include_language(language)]
+
+    def filename_for(table):
+        return '%s/%s.csv' % (directory, _csv_table_name(table, engine))
+
+    table_objs = [metadata.tables[table_name] for table_name in table_names]
+    results = {}
+    if workers > 1:
+        def dump_one(worker_session, table):
+            result = _dump_table(worker_session.connection(), table,
+                filename_for(table), language_ids_for(table))
+            return result, '%d rows, %d bytes' % result
+
+        # Dumping needs no particular order
+        results = _run_in_worker_sessions(engine, table_objs, dump_one,
+            workers, print_start, print_done, in_dependency_order=False)
+    else:
+        for table in table_objs:
+            print_start(_csv_table_name(table, engine))
+            results[table] = _dump_table(session.connection(), table,
+                filename_for(table), language_ids_for(table))
+            print_done('%d rows, %d bytes' % results[table])
 
-        print_done()
+    results = dict((_csv_table_name(table, engine), result)
+                   for table, result in results.items())
+
+    print_start('Total')
+    print_done('%d rows, %d bytes in %d tables' % (
+        sum(rows for rows, size in results.values()),
+        sum(size for rows, size in results.values()),
+        len(results),
+    ))
+
+    return results
+
+
+def _sqlite_schema_version():
+    """Returns a fingerprint of the schema, as created in SQLite.
+
+    Prebuilt databases store this as their `user_version`, so they aren't
+    used after the schema changes.
+    """
+    dialect = sqlalchemy.dialects.sqlite.dialect()
+    ddl = hashlib.sha1()
+    for table in metadata.sorted_tables:
+        elements = [sqlalchemy.schema.CreateTable(table)]
+        elements.extend(sqlalchemy.schema.CreateIndex(index)
+            for index in sorted(table.indexes, key=lambda index: index.name))
+        for element in elements:
+            sql = six.text_type(element.compile(dialect=dialect))
+            ddl.update(sql.encode('utf-8'))
+    # user_version is a signed 32-bit integer
+    return int(ddl.hexdigest()[:7], 16)
+
+def build_sqlite_artifact(path, directory=None, verbose=False):
+    """Loads all the CSV files into a fresh SQLite database at `path`, ready
+    to be copied into place by `pokedex setup`.
+
+    The database is fully indexed and VACUUMed, and records the schema and
+    the CSV files it was built from, so `sqlite_artifact_is_current` can
+    tell when it's out of date.
+    """
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    # Not connect(); that would rebind the metadata to an engine that's
+    # about to go away
+    engine = sqlalchemy.create_engine('sqlite:///' + temp_path)
+    session = orm.sessionmaker(class_=multilang.MultilangSession, bind=engine,
+        default_language_id=pokedex.db.ENGLISH_ID)()
+    try:
+        # Have load() record the manifest
+        manifest_table.create(bind=engine)
+        load(session, directory=directory, drop_tables=True, verbose=verbose,
+             safe=False)
+        session.close()
+
+        engine.execute("PRAGMA user_version = %d" % _sqlite_schema_version())
+        engine.execute("VACUUM")
+        engine.dispose()
+    except BaseException:
+        session.close()
+        engine.dispose()
+        os.remove(temp_path)
+        raise
+
+    _replace_file(temp_path, path)
+
+def sqlite_artifact_is_current(path, directory=None):
+    """Returns True if the prebuilt SQLite database at `path` exists, has the
+    current schema, and was built from CSV files identical to the ones in
+    `directory`.
+    """
+    if not os.path.exists(path):
+        return False
+
+    if directory is None:
+        directory = get_default_csv_dir()
+
+    # Not connect(); that would rebind the metadata
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    try:
+        connection = engine.connect()
+        try:
+            user_version = connection.execute("PRAGMA user_version").scalar()
+            if user_version != _sqlite_schema_version():
+                return False
+            if not manifest_table.exists(bind=connection):
+                return False
+            old_hashes = _read_manifest(connection)
+        finally:
+            connection.close()
+
+        new_hashes = _hash_csv_files(metadata.sorted_tables, directory, engine)
+    finally:
+        engine.dispose()
+
+    # Tables without any files don't get manifest entries
+    new_hashes = dict((name, hashes) for name, hashes in new_hashes.items()
+                      if hashes)
+    return old_hashes == new_hashes
+
+def install_sqlite_artifact(path, database_path):
+    """Copies the prebuilt SQLite database at `path` to `database_path`.
+
+    The old database is replaced atomically; connections that are already
+    open keep seeing it.
+    """
+    temp_path = database_path + '.tmp'
+    shutil.copyfile(path, temp_path)
+    _replace_file(temp_path, database_path)
+    multilang.translation_cache.clear()
+    markdown.html_cache.clear()
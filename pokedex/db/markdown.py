@@ -11,10 +11,13 @@ which case it is replaced by the name of the thing linked to.
 """
 from __future__ import absolute_import
 
+from contextlib import contextmanager
 import re
+import threading
 
 import markdown
 import six
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.session import object_session
 try:
     # Markdown 2.1+
@@ -23,6 +26,61 @@ except ImportError:
     # Old Markdown
     from markdown import etree, AtomicString
 
+from pokedex.util.cache import LRUCache
+
+# HTML that MarkdownString.as_html() has rendered, keyed by source text, the
+# string's language, the session's default language, and the extension's
+# class and cache_identity().  html_cache.stats() reports how well it's doing
+HTML_CACHE_SIZE = 4096
+html_cache = LRUCache(HTML_CACHE_SIZE)
+
+class _RendererPool(object):
+    """Keeps Markdown objects for one extension class, to reuse between
+    conversions instead of setting up a new one each time.
+
+    Markdown objects keep state while converting, so each is only lent to one
+    caller at a time.  The link pattern is pointed at the borrowing extension
+    and its session while it's out, and let go of when it comes back, so idle
+    renderers don't keep any session alive.
+    """
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def renderer(self, extension):
+        with self._lock:
+            md = self._idle.pop() if self._idle else None
+        if md is None:
+            md = markdown.Markdown(
+                extensions=['extra', extension],
+                safe_mode='escape',
+                output_format='xhtml1',
+            )
+        pattern = md.inlinePatterns['pokedex-link']
+        pattern.factory = extension
+        pattern.session = extension.session
+        try:
+            yield md
+        finally:
+            md.reset()
+            pattern.factory = pattern.session = None
+            with self._lock:
+                self._idle.append(md)
+
+# Extension class => _RendererPool
+_renderer_pools = {}
+_renderer_pools_lock = threading.Lock()
+
+def _renderer_pool(extension_class):
+    """Returns the `_RendererPool` for `extension_class`."""
+    pool = _renderer_pools.get(extension_class)
+    if pool is None:
+        with _renderer_pools_lock:
+            pool = _renderer_pools.setdefault(extension_class, _RendererPool())
+    return pool
+
 @six.python_2_unicode_compatible
 class MarkdownString(object):
     """Wraps a Markdown string.
@@ -60,18 +118,38 @@ class MarkdownString(object):
         The default is the session's markdown_extension. Usually that's a
         `PokedexLinkExtension` described below, which is also the recommended
         superclass.
+
+        For `PokedexLinkExtension`s, results are remembered in `html_cache`
+        under the extension's class and `cache_identity()`, and the Markdown
+        objects that render them are pooled per extension class.  Other
+        extensions get a new Markdown object and no caching.
         """
 
         if extension is None:
             extension = self.session.markdown_extension
 
-        md = markdown.Markdown(
-            extensions=['extra', extension],
-            safe_mode='escape',
-            output_format='xhtml1',
+        if not isinstance(extension, PokedexLinkExtension):
+            md = markdown.Markdown(
+                extensions=['extra', extension],
+                safe_mode='escape',
+                output_format='xhtml1',
+            )
+            return md.convert(self.source_text)
+
+        key = (
+            self.source_text,
+            getattr(self.language, 'id', self.language),
+            getattr(self.session, 'default_language_id', None),
+            type(extension),
+            extension.cache_identity(),
         )
-
-        return md.convert(self.source_text)
+        html = html_cache.get(key)
+        if html is None:
+            preload_links([self])
+            with _renderer_pool(type(extension)).renderer(extension) as md:
+                html = md.convert(self.source_text)
+            html_cache.put(key, html)
+        return html
 
     def as_text(self):
         """Returns the string in a plaintext-friendly form.
@@ -82,6 +160,7 @@ class MarkdownString(object):
         # the links by their text.
         # XXX: The tables get unaligned
 
+        preload_links([self])
         link_maker = PokedexLinkExtension(self.session)
         pattern = PokedexLinkPattern(link_maker, self.session, self.language)
         regex = '()%s()' % pattern.regex
@@ -164,7 +243,8 @@ class PokedexLinkPattern(markdown.inlinepatterns.Pattern):
 
     Handles matches using factory
     """
-    regex = u'(?x) \\[ ([^]]*) \\] \\{ ([-a-z0-9]+) : ([-a-z0-9 ]+) \\}'
+    # Markdown embeds this in a larger pattern, so it can't use inline flags
+    regex = u'\\[([^]]*)\\]\\{([-a-z0-9]+):([-a-z0-9 ]+)\\}'
 
     def __init__(self, factory, session, string_language=None, game_language=None):
         markdown.inlinepatterns.Pattern.__init__(self, self.regex)
@@ -174,38 +254,16 @@ class PokedexLinkPattern(markdown.inlinepatterns.Pattern):
         self.game_language = game_language
 
     def handleMatch(self, m):
-        from pokedex.db import tables, util
+        from pokedex.db import tables
         start, label, category, target, end = m.groups()
         try:
-            table = dict(
-                    ability=tables.Ability,
-                    item=tables.Item,
-                    location=tables.Location,
-                    move=tables.Move,
-                    pokemon=tables.PokemonSpecies,
-                    type=tables.Type,
-                    form=tables.PokemonForm,
-                )[category]
+            table = _link_tables()[category]
         except KeyError:
             obj = name = target
             url = self.factory.identifier_url(category, obj)
         else:
-            session = self.session
-            if table is tables.PokemonForm:
-                form_ident, pokemon_ident = target.split()
-                query = session.query(table)
-                query = query.filter(
-                        tables.PokemonForm.form_identifier == form_ident)
-                query = query.join(tables.PokemonForm.pokemon)
-                query = query.join(tables.Pokemon.species)
-                query = query.filter(
-                        tables.PokemonSpecies.identifier == pokemon_ident)
-            else:
-                query = session.query(table)
-                query = query.filter(table.identifier == target)
-            try:
-                obj = query.one()
-            except Exception:
+            obj = self._get_object(table, category, target)
+            if obj is None:
                 obj = name = target
                 url = self.factory.identifier_url(category, obj)
             else:
@@ -228,6 +286,38 @@ class PokedexLinkPattern(markdown.inlinepatterns.Pattern):
             el.text = AtomicString(label or name)
         return el
 
+    def _get_object(self, table, category, target):
+        """Returns the object linked to, or None if there isn't exactly one.
+
+        Objects found by `preload_links()` are used if there are any;
+        otherwise the object is queried for, and remembered in the same place.
+        """
+        from pokedex.db import tables
+        session = self.session
+        linked_objects = _linked_objects(session)
+        obj = linked_objects.get((category, target), _unresolved)
+        if obj is not _unresolved and (obj is None or obj in session):
+            return obj
+
+        if table is tables.PokemonForm:
+            form_ident, pokemon_ident = target.split()
+            query = session.query(table)
+            query = query.filter(
+                    tables.PokemonForm.form_identifier == form_ident)
+            query = query.join(tables.PokemonForm.pokemon)
+            query = query.join(tables.Pokemon.species)
+            query = query.filter(
+                    tables.PokemonSpecies.identifier == pokemon_ident)
+        else:
+            query = session.query(table)
+            query = query.filter(table.identifier == target)
+        try:
+            obj = query.one()
+        except Exception:
+            obj = None
+        linked_objects[category, target] = obj
+        return obj
+
 class PokedexLinkExtension(markdown.Extension):
     u"""Markdown extension that translates the syntax used in effect text:
 
@@ -242,6 +332,18 @@ class PokedexLinkExtension(markdown.Extension):
         pattern = PokedexLinkPattern(self, self.session)
         md.inlinePatterns['pokedex-link'] = pattern
 
+    def cache_identity(self):
+        """Return a hashable value that, together with the extension's class,
+        says which HTML this extension can share with others in `html_cache`.
+
+        The default is the database the session reads from, so that sessions
+        on the same database share rendered HTML.  Override this if links
+        also depend on the extension's own attributes.  Don't return anything
+        that refers to the session: the cache outlives it.
+        """
+        from pokedex.db.multilang import database_identity
+        return database_identity(self.session)
+
     def make_link(self, category, obj, url, text):
         """Make an <a> element
 
@@ -273,3 +375,97 @@ class PokedexLinkExtension(markdown.Extension):
         these do not have identifiers. Be sure to test this case.
         """
         return None
+
+
+def _link_tables():
+    """Returns a dict of link category => the table it links to."""
+    from pokedex.db import tables
+    return dict(
+        ability=tables.Ability,
+        item=tables.Item,
+        location=tables.Location,
+        move=tables.Move,
+        pokemon=tables.PokemonSpecies,
+        type=tables.Type,
+        form=tables.PokemonForm,
+    )
+
+_link_regex = re.compile(PokedexLinkPattern.regex)
+
+# Marks links that haven't been looked up
+_unresolved = object()
+
+def _linked_objects(session):
+    """Returns the dict of (category, target) => object, or None if nothing
+    matched, that remembers the links looked up with `session`.
+    """
+    return session.info.setdefault('pokedex_linked_objects', {})
+
+def preload_links(markdown_strings):
+    """Looks up every object that `markdown_strings` link to, with one query
+    per table, so rendering them afterwards doesn't take a query per link.
+
+    The objects are remembered by each string's session, along with their
+    names in its default language.  `as_html()` and `as_text()` do this for
+    their own string; call this first when rendering many.
+    """
+    from pokedex.db import tables
+    link_tables = _link_tables()
+    by_session = {}
+    for md_string in markdown_strings:
+        if md_string is None or md_string.session is None:
+            continue
+        session = md_string.session
+        linked_objects = _linked_objects(session)
+        wanted = by_session.setdefault(session, {})
+        for label, category, target in _link_regex.findall(
+                md_string.source_text):
+            if category in link_tables and (
+                    category, target) not in linked_objects:
+                wanted.setdefault(category, set()).add(target)
+
+    for session, wanted in by_session.items():
+        linked_objects = _linked_objects(session)
+        for category, targets in wanted.items():
+            table = link_tables[category]
+            found = {}
+            if table is tables.PokemonForm:
+                # Targets are "form pokemon"; leave any others for
+                # PokedexLinkPattern to complain about
+                pairs = dict(
+                    (tuple(target.split()), target) for target in targets
+                    if len(target.split()) == 2)
+                if not pairs:
+                    continue
+                targets = list(pairs.values())
+                query = session.query(table, tables.PokemonSpecies.identifier)
+                query = query.join(tables.PokemonForm.pokemon)
+                query = query.join(tables.Pokemon.species)
+                query = query.filter(tables.PokemonForm.form_identifier.in_(
+                    set(form_ident for form_ident, _ in pairs)))
+                query = query.filter(tables.PokemonSpecies.identifier.in_(
+                    set(pokemon_ident for _, pokemon_ident in pairs)))
+                query = query.options(joinedload(table.names_local))
+                for form, pokemon_ident in query:
+                    target = pairs.get((form.form_identifier, pokemon_ident))
+                    if target is not None:
+                        found.setdefault(target, []).append(form)
+            else:
+                query = session.query(table)
+                query = query.filter(table.identifier.in_(targets))
+                # Only the names are wanted, not the rest of the texts
+                query = query.options(joinedload(table.names_local))
+                if table is tables.Type:
+                    # Types may be named in the string's own language, so
+                    # name_map needs every name, and the languages to key
+                    # them by
+                    query = query.options(joinedload(tables.Type.names)
+                        .joinedload(tables.Type.names_table.local_language))
+                for obj in query:
+                    found.setdefault(obj.identifier, []).append(obj)
+
+            for target in targets:
+                objs = found.get(target, [])
+                # Like query.one(), ambiguous links don't count
+                linked_objects[category, target] = (
+                    objs[0] if len(objs) == 1 else None)
@@ -1,7 +1,15 @@
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from contextlib import contextmanager
 from functools import partial
+import threading
 
+from sqlalchemy import inspect
 from sqlalchemy.ext.associationproxy import association_proxy, AssociationProxy
 from sqlalchemy.orm import Query, aliased, mapper, relationship, synonym
+from sqlalchemy.orm.attributes import instance_state, set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.scoping import ScopedSession
 from sqlalchemy.orm.session import Session, object_session
@@ -12,12 +20,205 @@ from sqlalchemy.types import Integer
 
 from pokedex.db import markdown
 
+def database_identity(session):
+    """Returns a hashable value naming the database `session` reads from, for
+    keying caches shared between sessions without holding on to any of them.
+
+    This is normally the engine's URL.  Engines can set `pokedex_identity` to
+    tell apart databases that share one, like `connect(in_memory=True)` does.
+    """
+    try:
+        bind = session.get_bind()
+    except Exception:
+        return None
+    engine = getattr(bind, 'engine', bind)
+    identity = getattr(engine, 'pokedex_identity', None)
+    if identity is None:
+        identity = str(engine.url)
+    return identity
+
+class TranslationCache(object):
+    """A read-only cache of every translated text, shared by the whole process
+
+    The first time a text from a translation table is wanted, the whole table
+    is read, and kept as a dict of foreign id => language id => column values.
+    After that, the `(column)` and `(column)_map` proxies of any session
+    created with this cache are answered without touching the database; see
+    `pokedex.db.connect()`.  Tables are kept per database, as named by
+    `database_identity()`, so sessions on different databases don't see each
+    other's texts.
+
+    The cache never notices changes to the database.  Call `clear()` after
+    changing any translations; `pokedex.db.load` does so after loading.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Forgets every cached table."""
+        with self._lock:
+            self._tables.clear()
+
+    def texts(self, session, translation_class, foreign_id):
+        """Returns a dict of language id => dict of column values for the
+        given foreign id, reading the whole table with `session` if needed.
+        """
+        key = database_identity(session), translation_class
+        rows = self._tables.get(key)
+        if rows is None:
+            rows = self._load(session, key)
+        return rows.get(foreign_id, {})
+
+    def _load(self, session, key):
+        translation_class = key[1]
+        with self._lock:
+            rows = self._tables.get(key)
+            if rows is not None:
+                # Another thread beat us to it
+                return rows
+
+            table = translation_class.__table__
+            foreign_key, language_key = table.primary_key.columns.keys()
+            rows = {}
+            for row in session.execute(select([table])):
+                row = dict(row)
+                foreign_id = row.pop(foreign_key)
+                rows.setdefault(foreign_id, {})[row.pop(language_key)] = row
+            self._tables[key] = rows
+            return rows
+
+translation_cache = TranslationCache()
+
+
+def _cached_texts(obj, translation_class):
+    """Returns `obj`'s texts from its session's translation cache, or None if
+    the session doesn't have one.
+    """
+    session = object_session(obj)
+    cache = getattr(session, 'translation_cache', None)
+    if cache is None:
+        return None
+    # Take the id from the identity key, so an expired object isn't refreshed
+    state = instance_state(obj)
+    if state.key is None:
+        foreign_id = obj.id
+    else:
+        foreign_id, = state.key[1]
+    return session, cache.texts(session, translation_class, foreign_id)
+
+def _get_language(session, language_class, language_id):
+    """Gets a language from the session.
+
+    The session keeps hold of every language it has been asked for, since
+    the identity map alone would let them be garbage collected between texts.
+    """
+    languages = session.info.setdefault('translation_cache_languages', {})
+    language = languages.get(language_id)
+    if language is None or language not in session:
+        language = session.query(language_class).get(language_id)
+        languages[language_id] = language
+    return language
+
+def _cached_text(session, translation_class, column_name, language_id, texts):
+    """Converts a cached text as the column's proxies would."""
+    text = texts[column_name]
+    if text is None:
+        return text
+    column = translation_class.__table__.c[column_name]
+    string_getter = column.info.get('string_getter')
+    if string_getter is None:
+        return text
+    language = _get_language(
+        session, translation_class.language_class, language_id)
+    return string_getter(text, session, language)
+
+
+def _preloaded_rows(obj, translation_class):
+    """Returns the dict of language id => translation row, or None if there
+    is no text in that language, that `with_translations()` loaded for `obj`
+    in only some languages.
+
+    Returns None if there isn't one, or if the whole `(relation_name)`
+    collection has been loaded since.
+    """
+    relation_name = translation_class.relation_name
+    if relation_name in instance_state(obj).dict:
+        return None
+    return obj.__dict__.get('_preloaded_translations', {}).get(relation_name)
+
+class _PreloadedTranslationMap(Mapping):
+    """The `(column)_map` of an object whose texts `with_translations()`
+    loaded in only some languages.
+
+    Looking up one of those languages needs no query.  Anything else,
+    including iterating, reads the whole `(relation_name)` collection as
+    usual, so the map never seems to lack the other languages.
+    """
+    def __init__(self, proxy, obj, class_, rows):
+        self._proxy = proxy
+        self._obj = obj
+        self._class = class_
+        self._rows = rows
+
+    def _full_map(self):
+        return AssociationProxy.__get__(self._proxy, self._obj, self._class)
+
+    def __getitem__(self, language):
+        language_id = getattr(language, 'id', None)
+        if language_id not in self._rows:
+            return self._full_map()[language]
+        row = self._rows[language_id]
+        if row is None:
+            raise KeyError(language)
+        text = getattr(row, self._proxy.value_attr)
+        if text is None:
+            return text
+        column = self._proxy.translation_class.__table__.c[
+            self._proxy.value_attr]
+        string_getter = column.info.get('string_getter')
+        if string_getter is None:
+            return text
+        return string_getter(text, object_session(row), row.local_language)
+
+    def __iter__(self):
+        return iter(self._full_map())
+
+    def __len__(self):
+        return len(self._full_map())
+
+    def __setitem__(self, language, value):
+        self._full_map()[language] = value
+
+    def __delitem__(self, language):
+        del self._full_map()[language]
+
+
 class LocalAssociationProxy(AssociationProxy, ColumnOperators):
     """An association proxy for names in the default language
 
     Over the regular association_proxy, this provides sorting and filtering
     capabilities, implemented via SQL subqueries.
+
+    Reads from the session's `TranslationCache`, if it has one.
     """
+    def __init__(self, *args, **kwargs):
+        self.translation_class = kwargs.pop('translation_class', None)
+        super(LocalAssociationProxy, self).__init__(*args, **kwargs)
+
+    def __get__(self, obj, class_):
+        if obj is not None and self.translation_class is not None:
+            cached = _cached_texts(obj, self.translation_class)
+            if cached is not None:
+                session, texts = cached
+                language_id = session.default_language_id
+                if language_id not in texts:
+                    return None
+                return _cached_text(session, self.translation_class,
+                    self.value_attr, language_id, texts[language_id])
+        return super(LocalAssociationProxy, self).__get__(obj, class_)
+
     def __clause_element__(self):
         q = select([self.remote_attr])
         q = q.where(self.target_class.foreign_id == self.owning_class.id)
@@ -32,6 +233,36 @@ class LocalAssociationProxy(AssociationProxy, ColumnOperators):
         return exists(q)
 
 
+class TranslationMapProxy(AssociationProxy):
+    """An association proxy for texts in every language
+
+    Reads from the session's `TranslationCache`, if it has one.  The cached
+    dict is built afresh for each access, so changing it changes nothing.
+    Otherwise, texts that `MultilangQuery.with_translations()` loaded for some
+    languages are used for those languages.
+    """
+    def __init__(self, *args, **kwargs):
+        self.translation_class = kwargs.pop('translation_class')
+        super(TranslationMapProxy, self).__init__(*args, **kwargs)
+
+    def __get__(self, obj, class_):
+        if obj is not None:
+            cached = _cached_texts(obj, self.translation_class)
+            if cached is not None:
+                session, texts = cached
+                language_class = self.translation_class.language_class
+                return dict(
+                    (_get_language(session, language_class, language_id),
+                     _cached_text(session, self.translation_class,
+                         self.value_attr, language_id, language_texts))
+                    for language_id, language_texts in texts.items()
+                )
+            rows = _preloaded_rows(obj, self.translation_class)
+            if rows is not None:
+                return _PreloadedTranslationMap(self, obj, class_, rows)
+        return super(TranslationMapProxy, self).__get__(obj, class_)
+
+
 def _getset_factory_factory(column_name, string_getter):
     """Hello!  I am a factory for creating getset_factory functions for SQLA.
     I exist to avoid the closure-in-a-loop problem.
@@ -119,6 +350,7 @@ def create_translation_table(_table_name, foreign_class, relation_name,
     Translations = type(_table_name, (object,), {
         '_language_identifier': association_proxy('local_language', 'identifier'),
         'relation_name': relation_name,
+        'language_class': language_class,
         '__tablename__': _table_name,
     })
 
@@ -188,7 +420,8 @@ def create_translation_table(_table_name, foreign_class, relation_name,
         # Class.(column) -- accessor for the default language's value
         setattr(foreign_class, name,
             LocalAssociationProxy(local_relation_name, name,
-                    getset_factory=getset_factory))
+                    getset_factory=getset_factory,
+                    translation_class=Translations))
 
         # Class.(column)_map -- accessor for the language dict
         # Need a custom creator since Translations doesn't have an init, and
@@ -199,8 +432,9 @@ def create_translation_table(_table_name, foreign_class, relation_name,
             setattr(row, name, value)
             return row
         setattr(foreign_class, name + '_map',
-            association_proxy(relation_name, name, creator=creator,
-                    getset_factory=getset_factory))
+            TranslationMapProxy(relation_name, name, creator=creator,
+                    getset_factory=getset_factory,
+                    translation_class=Translations))
 
     # Add to the list of translation classes
     foreign_class.translation_classes.append(Translations)
@@ -209,11 +443,125 @@ def create_translation_table(_table_name, foreign_class, relation_name,
     return Translations
 
 class MultilangQuery(Query):
-    def __iter__(self):
+    # Set by with_translations()
+    _translation_languages = None
+
+    # Most ids to put in one IN clause
+    _translation_chunk_size = 500
+
+    def with_translations(self, *languages):
+        """Loads the translations of every object this query returns with one
+        query per translation table, rather than lazily per object.
+
+        With no arguments, the session's default language is loaded, for the
+        `(column)` proxies.  Otherwise `languages` are Language objects or
+        identifiers, and texts in each of them are loaded for the
+        `(column)_map` proxies.  Unless that's every language, the
+        `(relation_name)` collections are left alone, and looking up any
+        other language in the maps loads them as usual.
+
+        Relationships that are already loaded are never replaced.
+        """
+        q = self._clone()
+        q._translation_languages = languages
+        return q
+
+    def _set_default_language_param(self):
         if '_default_language_id' not in self._params or self._params['_default_language_id'] == 'dummy':
             self._params = self._params.copy()
             self._params['_default_language_id'] = self.session.default_language_id
-        return super(MultilangQuery, self).__iter__()
+
+    def _execute_and_instances(self, querycontext):
+        # Baked queries, which SQLA uses for lazy loads, skip __iter__ and
+        # come straight here.  Filling in the language as a parameter at the
+        # last moment lets one compiled statement serve every language
+        self._set_default_language_param()
+        return super(MultilangQuery, self)._execute_and_instances(querycontext)
+
+    def __iter__(self):
+        self._set_default_language_param()
+        results = super(MultilangQuery, self).__iter__()
+        if self._translation_languages is None:
+            return results
+
+        results = list(results)
+        self._load_translations(results)
+        return iter(results)
+
+    def _load_translations(self, results):
+        """Loads translations for the objects in `results`; see
+        `with_translations()`.
+        """
+        descriptions = self.column_descriptions
+        for index, description in enumerate(descriptions):
+            entity = description['entity']
+            # Skip plain columns
+            if entity is None or description['expr'] is not entity:
+                continue
+
+            if len(descriptions) == 1:
+                objects = results
+            else:
+                objects = [row[index] for row in results]
+            objects_by_id = dict(
+                (obj.id, obj) for obj in objects if obj is not None)
+            if not objects_by_id:
+                continue
+
+            cls = inspect(entity).class_
+            for translation_class in getattr(cls, 'translation_classes', ()):
+                self._load_translation_class(translation_class, objects_by_id)
+
+    def _load_translation_class(self, translation_class, objects_by_id):
+        session = self.session
+        default_language_id = self._params['_default_language_id']
+        language_class = translation_class.language_class
+        if self._translation_languages:
+            languages = [
+                language if isinstance(language, language_class)
+                else session.query(language_class)
+                    .filter_by(identifier=language).one()
+                for language in self._translation_languages
+            ]
+        else:
+            languages = [session.query(language_class).get(default_language_id)]
+        language_ids = [language.id for language in languages]
+
+        rows_by_id = dict((id, []) for id in objects_by_id)
+        ids = sorted(objects_by_id)
+        for start in range(0, len(ids), self._translation_chunk_size):
+            q = session.query(translation_class).filter(
+                translation_class.foreign_id.in_(
+                    ids[start:start + self._translation_chunk_size]),
+                translation_class.local_language_id.in_(language_ids),
+            )
+            for row in q:
+                rows_by_id[row.foreign_id].append(row)
+
+        # Only a load of every language can pass for the whole collection
+        complete = bool(self._translation_languages) and (
+            len(set(language_ids)) >= session.query(language_class).count())
+
+        relation_name = translation_class.relation_name
+        for id, obj in objects_by_id.items():
+            state = instance_state(obj)
+            rows = rows_by_id[id]
+            if (default_language_id in language_ids
+                    and relation_name + '_local' not in state.dict):
+                local_rows = [row for row in rows
+                              if row.local_language_id == default_language_id]
+                set_committed_value(obj, relation_name + '_local',
+                    local_rows[0] if local_rows else None)
+            if not self._translation_languages or relation_name in state.dict:
+                continue
+            if complete:
+                set_committed_value(obj, relation_name, rows)
+            else:
+                # Kept beside the relationship, for TranslationMapProxy
+                loaded = dict.fromkeys(language_ids)
+                loaded.update((row.local_language_id, row) for row in rows)
+                obj.__dict__.setdefault('_preloaded_translations', {})[
+                    relation_name] = loaded
 
 class MultilangSession(Session):
     """A tiny Session subclass that adds support for a default language.
@@ -222,11 +570,15 @@ class MultilangSession(Session):
     """
     default_language_id = None
     markdown_extension_class = markdown.PokedexLinkExtension
+    translation_cache = None
 
     def __init__(self, *args, **kwargs):
         if 'default_language_id' in kwargs:
             self.default_language_id = kwargs.pop('default_language_id')
 
+        if 'translation_cache' in kwargs:
+            self.translation_cache = kwargs.pop('translation_cache')
+
         markdown_extension_class = kwargs.pop('markdown_extension_class',
                 self.markdown_extension_class)
 
@@ -236,6 +588,46 @@ class MultilangSession(Session):
 
         super(MultilangSession, self).__init__(*args, **kwargs)
 
+    @contextmanager
+    def using_language(self, language):
+        """Makes `language` the default language inside a `with` block, then
+        puts the previous one back.
+
+        `language` is a Language object or id.  Texts in the default language
+        that were already loaded are expired on the way in and out, so nothing
+        is left showing the wrong language; nothing else is.  Queries run
+        inside are the same statements as outside, with only the language
+        parameter changed, so SQLA's cached lazy-load statements are reused.
+        """
+        language_id = getattr(language, 'id', language)
+        old_language_id = self.default_language_id
+        if language_id == old_language_id:
+            yield self
+            return
+
+        self.default_language_id = language_id
+        self._expire_local_translations()
+        try:
+            yield self
+        finally:
+            self.default_language_id = old_language_id
+            self._expire_local_translations()
+
+    def _expire_local_translations(self):
+        """Expires the loaded `(relation_name)_local` relationships of every
+        object in the session.
+        """
+        for obj in list(self.identity_map.values()):
+            state = instance_state(obj)
+            local_names = [
+                translation_class.relation_name + '_local'
+                for translation_class in getattr(
+                    type(obj), 'translation_classes', ())
+            ]
+            loaded_names = [name for name in local_names if name in state.dict]
+            if loaded_names:
+                self.expire(obj, loaded_names)
+
 class MultilangScopedSession(ScopedSession):
     """Dispatches language selection to the attached Session."""
 
@@ -252,3 +644,10 @@ class MultilangScopedSession(ScopedSession):
     @property
     def markdown_extension(self):
         return self.registry().markdown_extension
+
+    @property
+    def translation_cache(self):
+        return self.registry().translation_cache
+
+    def using_language(self, language):
+        return self.registry().using_language(language)
@@ -27,6 +27,18 @@ def get_default_index_dir_with_origin():
 
     return index_dir, origin
 
+def get_default_sqlite_artifact_with_origin():
+    path = os.environ.get('POKEDEX_SQLITE_ARTIFACT', None)
+    origin = 'environment'
+
+    if path is None:
+        import pkg_resources
+        path = pkg_resources.resource_filename('pokedex',
+                                               'data/pokedex.prebuilt.sqlite')
+        origin = 'default'
+
+    return path, origin
+
 def get_default_csv_dir_with_origin():
     import pkg_resources
     csv_dir = pkg_resources.resource_filename('pokedex', 'data/csv')
@@ -41,6 +53,9 @@ def get_default_db_uri():
 def get_default_index_dir():
     return get_default_index_dir_with_origin()[0]
 
+def get_default_sqlite_artifact():
+    return get_default_sqlite_artifact_with_origin()[0]
+
 def get_default_csv_dir():
     return get_default_csv_dir_with_origin()[0]
 
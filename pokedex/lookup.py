@@ -1,10 +1,19 @@
 # encoding: utf8
+from bisect import bisect_left
+import contextlib
+import hashlib
+import io
+import json
 import os, os.path
 import random
 import re
+import threading
 import unicodedata
 
-from six import text_type
+from six import string_types, text_type, unichr
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.util import identity_key
 import whoosh
 import whoosh.index
 import whoosh.query
@@ -16,6 +25,7 @@ from pokedex.compatibility import namedtuple
 from pokedex.db import connect
 import pokedex.db.tables as tables
 from pokedex.roomaji import romanize
+from pokedex.util.cache import LRUCache
 from pokedex.defaults import get_default_index_dir
 
 __all__ = ['PokedexLookup']
@@ -25,6 +35,10 @@ LookupResult = namedtuple('LookupResult', [
     'object', 'indexed_name', 'name', 'language', 'iso639', 'iso3166', 'exact',
 ])
 
+AutocompleteResult = namedtuple('AutocompleteResult', [
+    'name', 'indexed_name', 'table', 'row_id', 'language', 'iso639', 'iso3166',
+])
+
 class UninitializedIndex(object):
     class UninitializedIndexError(Exception):
         pass
@@ -93,11 +107,342 @@ def _table_facet_impl(searcher, docnum):
 table_facet = whoosh.sorting.FunctionFacet(_table_facet_impl)
 
 
+# Stored fields of an indexed name, in the order the memory index saves them
+_document_fields = (
+    'name', 'display_name', 'table', 'row_id', 'language', 'iso639', 'iso3166',
+)
+# Fields the memory index can search on
+_searchable_fields = ('name', 'table', 'row_id', 'iso639', 'iso3166')
+
+class MemoryIndex(object):
+    """A stand-in for the whoosh index that keeps every indexed name in
+    memory.  The lookup vocabulary is small and fixed, so a sorted array of
+    names is plenty for exact, prefix, and wildcard matching, and avoids
+    whoosh's per-query overhead.
+
+    Only implements the parts of whoosh's index and searcher interfaces that
+    `PokedexLookup` uses.  Documents are numbered in the order they were
+    indexed, just like whoosh, so both give the same results.
+    """
+
+    FILENAME = 'MEMORY_documents.json'
+
+    def __init__(self, documents):
+        self.documents = list(documents)
+
+        # field => value => list of docnums
+        self.postings = {}
+        for field in _searchable_fields:
+            postings = self.postings[field] = {}
+            for docnum, document in enumerate(self.documents):
+                value = document.get(field)
+                if value is None:
+                    continue
+                elif value in postings:
+                    postings[value].append(docnum)
+                else:
+                    postings[value] = [docnum]
+
+        # field => sorted values, for prefix and wildcard matching
+        self.sorted_terms = dict(
+            (field, sorted(terms)) for field, terms in self.postings.items())
+
+        self._fuzzy_indices = {}
+
+    @classmethod
+    def load(cls, directory):
+        """Loads the index saved in `directory` by `save()`."""
+        with io.open(os.path.join(directory, cls.FILENAME),
+                     encoding='utf-8') as f:
+            rows = json.load(f)
+        return cls(dict(zip(_document_fields, row)) for row in rows)
+
+    def save(self, directory):
+        """Saves the index to a file in `directory`."""
+        rows = [[document.get(field) for field in _document_fields]
+                for document in self.documents]
+        with io.open(os.path.join(directory, self.FILENAME), 'w',
+                     encoding='utf-8') as f:
+            f.write(text_type(json.dumps(rows, ensure_ascii=False)))
+
+    def searcher(self):
+        return MemorySearcher(self)
+
+    def fuzzy_index(self, field):
+        """Returns a `FuzzyIndex` of the terms in `field`, built on first
+        use.
+        """
+        if field not in self._fuzzy_indices:
+            self._fuzzy_indices[field] = FuzzyIndex.from_frequencies(dict(
+                (term, len(docnums))
+                for term, docnums in self.postings[field].items()))
+        return self._fuzzy_indices[field]
+
+    def matching_docnums(self, query):
+        """Returns the set of docnums matching a whoosh query.  Only the kinds
+        of query `PokedexLookup` builds are supported.
+        """
+        if isinstance(query, whoosh.query.And):
+            docnums = None
+            for subquery in query.subqueries:
+                subquery_docnums = self.matching_docnums(subquery)
+                if docnums is None:
+                    docnums = subquery_docnums
+                else:
+                    docnums &= subquery_docnums
+            return docnums or set()
+        elif isinstance(query, whoosh.query.Or):
+            docnums = set()
+            for subquery in query.subqueries:
+                docnums |= self.matching_docnums(subquery)
+            return docnums
+        elif query is whoosh.query.NullQuery:
+            return set()
+        elif isinstance(query, whoosh.query.Every):
+            # e.g. the wildcard "*"
+            return self._matching_terms(query.fieldname, u'')
+        elif isinstance(query, whoosh.query.Term):
+            return set(self.postings[query.fieldname].get(query.text, ()))
+        elif isinstance(query, whoosh.query.Prefix):
+            return self._matching_terms(query.fieldname, query.text)
+        elif isinstance(query, whoosh.query.Wildcard):
+            # Only the part before the first wildcard can narrow the search
+            prefix = re.split(u'[*?]', query.text, 1)[0]
+            pattern = re.compile(u''.join(
+                u'.*' if c == u'*' else u'.' if c == u'?' else re.escape(c)
+                for c in query.text) + u'$', re.DOTALL)
+            return self._matching_terms(query.fieldname, prefix, pattern)
+        else:
+            raise TypeError("Can't search a MemoryIndex for %r" % (query,))
+
+    def _matching_terms(self, field, prefix, pattern=None):
+        """Returns the docnums of every term in `field` that starts with
+        `prefix`, and also matches the regex `pattern` if one is given.
+        """
+        terms = self.sorted_terms[field]
+        postings = self.postings[field]
+        docnums = set()
+        i = bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix):
+            if pattern is None or pattern.match(terms[i]):
+                docnums.update(postings[terms[i]])
+            i += 1
+        return docnums
+
+class MemorySearcher(object):
+    """Searches a `MemoryIndex`, duck-typing a whoosh searcher."""
+
+    def __init__(self, index):
+        self._ix = index
+        self.is_closed = False
+
+    def refresh(self):
+        return self
+
+    def close(self):
+        self.is_closed = True
+
+    def stored_fields(self, docnum):
+        return self._ix.documents[docnum]
+
+    def corrector(self, fieldname):
+        return self._ix.fuzzy_index(fieldname)
+
+    def search(self, query, limit=10, sortedby=None):
+        """Returns the stored fields of the documents matching `query`,
+        ordered by the `sortedby` facet and then by docnum.
+        """
+        docnums = self._ix.matching_docnums(query)
+        if sortedby is None:
+            docnums = sorted(docnums)
+        else:
+            facet_key = self._facet_key(sortedby)
+            docnums = sorted(docnums,
+                             key=lambda docnum: (facet_key(docnum), docnum))
+        if limit is not None:
+            docnums = docnums[:limit]
+        return [self._ix.documents[docnum] for docnum in docnums]
+
+    def _facet_key(self, facet):
+        """Turns a whoosh facet into a function from docnum to sort key."""
+        if isinstance(facet, whoosh.sorting.MultiFacet):
+            keys = [self._facet_key(subfacet) for subfacet in facet.facets]
+            return lambda docnum: tuple(key(docnum) for key in keys)
+        elif isinstance(facet, whoosh.sorting.FunctionFacet):
+            return lambda docnum: facet.fn(self, docnum)
+        elif isinstance(facet, whoosh.sorting.FieldFacet) and not facet.reverse:
+            field = facet.fieldname
+            return lambda docnum: self._ix.documents[docnum][field]
+        elif isinstance(facet, string_types):
+            return lambda docnum: self._ix.documents[docnum][facet]
+        else:
+            raise TypeError("Can't sort a MemoryIndex by %r" % (facet,))
+
+def _hash_rows(rows):
+    """Returns a hex digest of a list of `(row id, language id, name)`."""
+    hasher = hashlib.sha1()
+    for row in rows:
+        hasher.update(json.dumps(row, ensure_ascii=False).encode('utf-8'))
+        hasher.update(b'\n')
+    return hasher.hexdigest()
+
+def _rank_suggestions(suggestions, limit):
+    """Picks the best `limit` of a list of `(distance, -frequency, term)`
+    spelling suggestions, and returns their terms in order.
+
+    Matches whoosh's corrector: closest first, then most common, then
+    alphabetical, but ties at the cutoff go to the later terms.
+    """
+    suggestions = sorted(suggestions, key=lambda s: s[2], reverse=True)
+    suggestions.sort(key=lambda s: s[:2])
+    return [term for distance, frequency, term
+            in sorted(suggestions[:limit])]
+
+class FuzzyIndex(object):
+    """A trie of every indexed name and how many documents have it, for
+    finding misspelled names.
+
+    Suggestions are found by walking the trie while filling in one row of the
+    Damerau-Levenshtein table per node.  A branch is abandoned as soon as its
+    row is entirely over the maximum distance, so most of the trie is never
+    visited, and names sharing a prefix share the work of comparing it.
+    """
+
+    FILENAME = 'FUZZY_names.json'
+
+    def __init__(self, trie):
+        # Nested dicts of character => subtrie; the key u'' marks the end of
+        # a name, and holds its frequency
+        self.trie = trie
+
+    @classmethod
+    def from_frequencies(cls, frequencies):
+        """Builds the trie from a dict of name => frequency."""
+        trie = {}
+        for term, frequency in frequencies.items():
+            node = trie
+            for c in term:
+                node = node.setdefault(c, {})
+            node[u''] = frequency
+        return cls(trie)
+
+    @classmethod
+    def load(cls, directory):
+        """Loads the index saved in `directory` by `save()`."""
+        with io.open(os.path.join(directory, cls.FILENAME),
+                     encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def save(self, directory):
+        """Saves the index to a file in `directory`."""
+        with io.open(os.path.join(directory, self.FILENAME), 'w',
+                     encoding='utf-8') as f:
+            f.write(text_type(json.dumps(self.trie, ensure_ascii=False)))
+
+    def within(self, text, maxdist):
+        """Yields `(term, distance, frequency)` for every name within
+        `maxdist` edits of `text`.
+        """
+        n = len(text)
+        first_row = list(range(n + 1))
+        # Each entry: subtrie, prefix it stands for, the table rows for the
+        # prefix minus its last one and two characters
+        stack = [(node, c, first_row, None)
+                 for c, node in self.trie.items() if c]
+        while stack:
+            node, prefix, prev_row, prev_prev_row = stack.pop()
+            c = prefix[-1]
+            before_c = prefix[-2] if len(prefix) > 1 else None
+
+            row = [prev_row[0] + 1]
+            for i in range(1, n + 1):
+                cost = prev_row[i - 1] + (text[i - 1] != c)
+                if prev_row[i] + 1 < cost:
+                    cost = prev_row[i] + 1
+                if row[i - 1] + 1 < cost:
+                    cost = row[i - 1] + 1
+                # Transposition
+                if (prev_prev_row is not None and i > 1 and
+                        text[i - 1] == before_c and text[i - 2] == c and
+                        prev_prev_row[i - 2] + 1 < cost):
+                    cost = prev_prev_row[i - 2] + 1
+                row.append(cost)
+
+            if row[n] <= maxdist and u'' in node:
+                yield prefix, row[n], node[u'']
+            if min(row) <= maxdist:
+                for next_c, subtrie in node.items():
+                    if next_c:
+                        stack.append((subtrie, prefix + next_c, row, prev_row))
+
+    def suggest(self, text, limit=5, maxdist=2):
+        """Returns up to `limit` names close to `text`, ranked like whoosh's
+        corrector does.
+        """
+        return _rank_suggestions(
+            [(distance, -frequency, term)
+             for term, distance, frequency in self.within(text, maxdist)
+             if term != text],
+            limit)
+
+
+class _UnaccentedCharacters(dict):
+    """Maps character ordinals to the same characters with their accents
+    removed, for `unicode.translate`.  Each character is worked out the first
+    time it's seen.
+    """
+    def __missing__(self, ordinal):
+        # http://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-in-a-python-unicode-string
+        # Makes sense to me.  Decompose by Unicode rules, then remove combining
+        # characters; normalize_name() recombines what's left.  I'm explicitly
+        # doing it this way instead of testing combining() because Korean
+        # characters apparently decompose!  But the results are considered
+        # letters, not combining characters, so testing for Mn works well, and
+        # combining them again makes them look right.
+        nkfd_form = unicodedata.normalize('NFKD', unichr(ordinal))
+        unaccented = u"".join(c for c in nkfd_form
+                              if unicodedata.category(c) != 'Mn')
+        self[ordinal] = unaccented
+        return unaccented
+
+_unaccented_characters = _UnaccentedCharacters()
+
+# Names normalize_name() has seen, and what they normalized to.  This is a
+# plain dict, emptied whenever it fills up, because normalizing is already
+# too quick for an LRUCache's bookkeeping to pay off
+_normalized_names = {}
+_NORMALIZED_NAMES_SIZE = 65536
+
+def normalize_name(name):
+    """Strips irrelevant formatting junk from name input.
+
+    Specifically: everything is lowercased, and accents are removed.
+    """
+    try:
+        return _normalized_names[name]
+    except KeyError:
+        pass
+
+    normalized = text_type(name).translate(_unaccented_characters)
+    normalized = unicodedata.normalize('NFC', normalized)
+    normalized = normalized.strip()
+    normalized = normalized.lower()
+
+    if len(_normalized_names) >= _NORMALIZED_NAMES_SIZE:
+        _normalized_names.clear()
+    _normalized_names[name] = normalized
+    return normalized
+
+
 class PokedexLookup(object):
     MAX_FUZZY_RESULTS = 10
     MAX_EXACT_RESULTS = 43
+    MAX_PREFIX_RESULTS = 10
     INTERMEDIATE_FACTOR = 2
 
+    # Number of answers autocomplete() remembers
+    AUTOCOMPLETE_CACHE_SIZE = 4096
+
     # Dictionary of table name => table class.
     # Need the table name so we can get the class from the table name after we
     # retrieve something from the index
@@ -120,7 +465,10 @@ class PokedexLookup(object):
     )
 
 
-    def __init__(self, directory=None, session=None):
+    backends = ('whoosh', 'memory')
+
+    def __init__(self, directory=None, session=None, backend='whoosh',
+                 cache_size=0, cache_ttl=None):
         """Opens the whoosh index stored in the named directory.  If the index
         doesn't already exist, it will be created.
 
@@ -128,10 +476,26 @@ class PokedexLookup(object):
             Directory containing the index.  Defaults to a location within the
             `pokedex` egg directory.
 
+        `backend`
+            Either 'whoosh' to search the whoosh index, or 'memory' to load
+            every name into a `MemoryIndex` instead.  Both give the same
+            results; the in-memory index searches faster, but is slower to
+            open and keeps every name in memory.
+
         `session`
             Used for creating the index and retrieving objects.  Defaults to an
             attempt to connect to the default SQLite database installed by
-            `pokedex setup`.
+            `pokedex setup`, sharing its engine with any other session
+            connected to it.
+
+        `cache_size`
+            If nonzero, `lookup()` remembers the index records it found for up
+            to this many distinct queries, in `lookup_cache`.  The cache is
+            emptied whenever the index is rebuilt.
+
+        `cache_ttl`
+            If given, cached lookups are also forgotten after this many
+            seconds.
         """
 
         # By the time this returns, self.index and self.session must be set
@@ -142,6 +506,29 @@ class PokedexLookup(object):
 
         self.directory = directory
 
+        if backend not in self.backends:
+            raise ValueError("Unknown lookup backend %r" % (backend,))
+        self.backend = backend
+
+        # Loaded by _get_corrector()
+        self._fuzzy_index = None
+
+        self.autocomplete_cache = LRUCache(self.AUTOCOMPLETE_CACHE_SIZE)
+        if cache_size:
+            self.lookup_cache = LRUCache(cache_size, ttl=cache_ttl)
+        else:
+            self.lookup_cache = None
+
+        # Language identifier => id; loaded by _whoosh_records_to_results()
+        self._language_ids = None
+
+        # Loaded by _get_random_ids()
+        self._random_ids = None
+
+        # Searchers that aren't in use; see _searcher()
+        self._idle_searchers = []
+        self._searchers_lock = threading.Lock()
+
         if session:
             self.session = session
         else:
@@ -159,18 +546,182 @@ class PokedexLookup(object):
         # Note that this will explode if the directory exists but doesn't
         # contain an index; that's a feature
         try:
-            self.index = whoosh.index.open_dir(directory, indexname='MAIN')
+            if backend == 'memory':
+                self.index = MemoryIndex.load(directory)
+            else:
+                self.index = whoosh.index.open_dir(directory, indexname='MAIN')
         except whoosh.index.EmptyIndexError:
             raise IOError(
                 "The index directory already contains files.  "
                 "Please use a dedicated directory for the lookup index."
             )
 
-    def rebuild_index(self):
-        """Creates the index from scratch."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the index files held open by idle searchers.
+
+        The lookup may still be used afterwards; it will open new searchers as
+        it needs them.
+        """
+        with self._searchers_lock:
+            idle_searchers = self._idle_searchers
+            self._idle_searchers = []
+        for searcher in idle_searchers:
+            searcher.close()
+
+    @contextlib.contextmanager
+    def _searcher(self):
+        """Lends out a whoosh searcher for the duration of a `with` block.
+
+        Searchers are kept open between lookups, since opening one is slow.
+        Each thread borrows its own, so a lookup object may be shared among
+        threads.  A searcher for an index generation that's no longer current
+        is refreshed before being lent out again, and the caches of the old
+        generation are forgotten.
+        """
+        with self._searchers_lock:
+            if self._idle_searchers:
+                searcher = self._idle_searchers.pop()
+            else:
+                searcher = None
+
+        if searcher is None:
+            searcher = self.index.searcher()
+        elif searcher._ix is not self.index:
+            # The index was rebuilt since this searcher was opened
+            searcher.close()
+            searcher = self.index.searcher()
+        else:
+            refreshed = searcher.refresh()
+            if refreshed is not searcher:
+                # Another process rebuilt the index; what we remember of the
+                # old one is stale
+                self._forget_index_caches()
+            searcher = refreshed
+
+        try:
+            yield searcher
+        finally:
+            with self._searchers_lock:
+                self._idle_searchers.append(searcher)
+
+    def _check_index_generation(self):
+        """Forgets cached results if the index on disk has changed since the
+        last search, as `_searcher()` does.  Call this before answering from a
+        cache without searching.
+        """
+        with self._searcher():
+            pass
+
+    def _get_corrector(self, searcher):
+        """Returns the `FuzzyIndex` saved with the index, loading it on first
+        use.  Indices built before there was one fall back to the searcher's
+        own, slower corrector.
+        """
+        if self._fuzzy_index is None:
+            if not os.path.exists(
+                    os.path.join(self.directory, FuzzyIndex.FILENAME)):
+                return searcher.corrector('name')
+            # Threads might both load it, but that's harmless
+            self._fuzzy_index = FuzzyIndex.load(self.directory)
+        return self._fuzzy_index
+
+    def rebuild_index(self, workers=1, incremental=False):
+        """Creates the index from scratch.
+
+        Both backends' indices are written, so either may open the directory
+        afterwards.
+
+        `workers`
+            Number of processes whoosh uses to write the index, each writing
+            its own segment.  Documents in different segments aren't numbered
+            in the order they were added, so results that tie in the sort
+            order may come back in a different order than after a serial
+            rebuild.
+
+        `incremental`
+            If true, only reindex the tables whose names changed since the
+            index was last built, and leave the rest alone.  Falls back to a
+            full rebuild if there's no index to update.  A changed table's
+            documents are deleted and added again at the end of the index, so
+            as with `workers`, results that tie in the sort order may come
+            back in a different order than after a full rebuild.
+        """
+
+        names = self._select_names()
+        hashes = dict((table_name, _hash_rows(rows))
+                      for table_name, rows in names.items())
+
+        old_hashes = None
+        if incremental:
+            old_hashes = self._read_table_hashes()
+
+        if old_hashes is not None:
+            changed_tables = [table_name for table_name in names
+                              if hashes[table_name] != old_hashes.get(table_name)]
+            if not changed_tables:
+                return
+
+            whoosh_index = whoosh.index.open_dir(self.directory,
+                                                 indexname='MAIN')
+            writer = self._whoosh_writer(whoosh_index, workers)
+            for table_name in changed_tables:
+                writer.delete_by_term(u'table', text_type(table_name))
+        else:
+            changed_tables = list(names)
+            whoosh_index = self._create_whoosh_index()
+            writer = self._whoosh_writer(whoosh_index, workers)
+
+        languages = dict(
+            (language.id, language)
+            for language in self.session.query(tables.Language))
+        for table_name in changed_tables:
+            for document in self._iter_documents(
+                    table_name, names[table_name], languages):
+                writer.add_document(**document)
+        writer.commit()
+
+        # Save the same names for the memory backend, and for fuzzy matching.
+        # Copy them back out of whoosh, so the documents are in the same
+        # order for both backends
+        with whoosh_index.searcher() as searcher:
+            memory_index = MemoryIndex(
+                searcher.stored_fields(docnum)
+                for docnum in searcher.reader().all_doc_ids())
+        memory_index.save(self.directory)
+        fuzzy_index = memory_index.fuzzy_index('name')
+        fuzzy_index.save(self.directory)
+        self._write_table_hashes(hashes)
+
+        if self.backend == 'memory':
+            self.index = memory_index
+        else:
+            self.index = whoosh_index
+        self._forget_index_caches()
+        self._fuzzy_index = fuzzy_index
+
+    def _forget_index_caches(self):
+        """Forgets everything remembered from the index: cached lookups and
+        autocompletions, random ids, and the spelling corrector.  Called
+        whenever the index changes, whether this object rebuilt it or
+        `_searcher()` found a newer one on disk.
+        """
+        self.autocomplete_cache.clear()
+        if self.lookup_cache is not None:
+            self.lookup_cache.clear()
+        self._random_ids = None
+        self._fuzzy_index = None
+
+    def _create_whoosh_index(self):
+        """Deletes any existing index, and creates an empty whoosh index."""
 
         schema = whoosh.fields.Schema(
-            name=whoosh.fields.ID(sortable=True, stored=True, spelling=True),
+            name=whoosh.fields.ID(sortable=True, stored=True),
             table=whoosh.fields.ID(sortable=True, stored=True),
             row_id=whoosh.fields.ID(sortable=True, stored=True),
             language=whoosh.fields.STORED,
@@ -179,56 +730,101 @@ class PokedexLookup(object):
             display_name=whoosh.fields.STORED,  # non-lowercased name
         )
 
+        # Carry on the old index's generation numbers, so that searchers still
+        # open on it elsewhere see the new one as newer; see _searcher()
+        generation = 0
+        if whoosh.index.exists_in(self.directory, indexname='MAIN'):
+            generation = whoosh.index.open_dir(
+                self.directory, indexname='MAIN').latest_generation()
+
+        # Don't keep the files we're about to delete open
+        self.close()
+
         if os.path.exists(self.directory):
             # create_in() isn't totally reliable, so just nuke whatever's there
             # manually.  Try to be careful about this...
             for f in os.listdir(self.directory):
-                if re.match('^_?(MAIN|SPELL)_', f):
+                if re.match('^_?(MAIN|SPELL|MEMORY|FUZZY|HASHES)_', f):
                     os.remove(os.path.join(self.directory, f))
         else:
             os.mkdir(self.directory)
 
-        self.index = whoosh.index.create_in(self.directory, schema=schema,
-                                                            indexname='MAIN')
-        writer = self.index.writer()
-
-        # Index every name in all our tables of interest
-        for cls in self.indexed_tables.values():
-            q = self.session.query(cls).order_by(cls.id)
-
-            for row in q:
-                row_key = dict(table=text_type(cls.__tablename__),
-                               row_id=text_type(row.id))
+        whoosh_index = whoosh.index.create_in(self.directory, schema=schema,
+                                              indexname='MAIN')
+        if generation > 0:
+            whoosh.index.TOC(schema, [], generation).write(
+                whoosh_index.storage, 'MAIN')
+        return whoosh_index
 
-                def add(name, language, iso639, iso3166):
-                    normalized_name = self.normalize_name(name)
-
-                    writer.add_document(
-                        name=normalized_name, display_name=name,
-                        language=language, iso639=iso639, iso3166=iso3166,
-                        **row_key
-                    )
+    def _whoosh_writer(self, whoosh_index, workers):
+        if workers > 1:
+            return whoosh_index.writer(procs=workers, multisegment=True)
+        else:
+            return whoosh_index.writer()
 
-                if cls == tables.PokemonForm:
-                    name_map = 'pokemon_name_map'
-                else:
-                    name_map = 'name_map'
+    _hashes_filename = 'HASHES_tables.json'
 
-                for language, name in getattr(row, name_map, {}).items():
-                    if not name:
-                        continue
+    def _read_table_hashes(self):
+        """Returns the table name => hash dict saved by the last rebuild, or
+        None if there's no index to update.
+        """
+        path = os.path.join(self.directory, self._hashes_filename)
+        if not os.path.exists(path) or not whoosh.index.exists_in(
+                self.directory, indexname='MAIN'):
+            return None
+        with io.open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_table_hashes(self, hashes):
+        with io.open(os.path.join(self.directory, self._hashes_filename), 'w',
+                     encoding='utf-8') as f:
+            f.write(text_type(json.dumps(hashes, sort_keys=True)))
+
+    def _select_names(self):
+        """Returns a dict of table name => list of `(row id, language id,
+        name)` for every indexed table, read straight from the translation
+        tables rather than through the ORM.
+        """
+        names = {}
+        for table_name, cls in self.indexed_tables.items():
+            translations = cls.names_table.__table__
+            id_column = translations.c[cls.__singlename__ + '_id']
+            if cls == tables.PokemonForm:
+                name_column = translations.c.pokemon_name
+            else:
+                name_column = translations.c.name
+
+            q = select([id_column, translations.c.local_language_id,
+                        name_column])
+            q = q.where(name_column != None)
+            q = q.order_by(id_column, translations.c.local_language_id)
+            names[table_name] = [tuple(row) for row in self.session.execute(q)]
+        return names
+
+    def _iter_documents(self, table_name, rows, languages):
+        """Yields the stored fields of every name to index, as dicts, given
+        `rows` from `_select_names()` and a dict of languages by id.
+        """
+        for row_id, language_id, name in rows:
+            if not name:
+                continue
+            language = languages[language_id]
 
-                    add(name, language.identifier,
-                              language.iso639,
-                              language.iso3166)
+            def document(name):
+                return dict(
+                    name=self.normalize_name(name), display_name=name,
+                    language=language.identifier, iso639=language.iso639,
+                    iso3166=language.iso3166,
+                    table=text_type(table_name), row_id=text_type(row_id),
+                )
 
-                    # Add generated Roomaji too
-                    # XXX this should be a first-class concept, not
-                    # piggybacking on Japanese
-                    if language.identifier == 'ja':
-                        add(romanize(name), language.identifier, language.iso639, language.iso3166)
+            yield document(name)
 
-        writer.commit()
+            # Add generated Roomaji too
+            # XXX this should be a first-class concept, not
+            # piggybacking on Japanese
+            if language.identifier == 'ja':
+                yield document(romanize(name))
 
 
     def normalize_name(self, name):
@@ -236,22 +832,7 @@ class PokedexLookup(object):
 
         Specifically: everything is lowercased, and accents are removed.
         """
-        # http://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-in-a-python-unicode-string
-        # Makes sense to me.  Decompose by Unicode rules, then remove combining
-        # characters, then recombine.  I'm explicitly doing it this way instead
-        # of testing combining() because Korean characters apparently
-        # decompose!  But the results are considered letters, not combining
-        # characters, so testing for Mn works well, and combining them again
-        # makes them look right.
-        nkfd_form = unicodedata.normalize('NFKD', text_type(name))
-        name = u"".join(c for c in nkfd_form
-                        if unicodedata.category(c) != 'Mn')
-        name = unicodedata.normalize('NFC', name)
-
-        name = name.strip()
-        name = name.lower()
-
-        return name
+        return normalize_name(name)
 
 
     def _apply_valid_types(self, name, valid_types):
@@ -356,19 +937,20 @@ class PokedexLookup(object):
         # Bogus.  Be nice and return dummy
         return None
 
-    def _whoosh_records_to_results(self, records, exact=True):
+    def _whoosh_records_to_results(self, records, exact=True, objects=None):
         """Converts a list of whoosh's indexed records to LookupResult tuples
         containing database objects.
+
+        `objects` may give the objects already fetched by `_load_objects()`.
         """
-        # XXX cache me?
-        languages = dict(
-            (row.identifier, row)
-            for row in self.session.query(tables.Language)
-        )
+        if self._language_ids is None:
+            self._language_ids = dict(
+                self.session.query(tables.Language.identifier,
+                                   tables.Language.id))
         # XXX this 'exact' thing is getting kinda leaky.  would like a better
         # way to handle it, since only lookup() cares about fuzzy results
         seen = {}
-        results = []
+        unique_records = []
         for record in records:
             # Skip dupes
             seen_key = record['table'], record['row_id']
@@ -376,20 +958,66 @@ class PokedexLookup(object):
                 continue
             seen[seen_key] = True
 
-            # XXX minimize queries here?
-            cls = self.indexed_tables[record['table']]
-            obj = self.session.query(cls).get(record['row_id'])
+            unique_records.append(record)
+
+        if objects is None:
+            objects = self._load_objects(unique_records)
+
+        results = []
+        for record in unique_records:
+            obj = objects.get((record['table'], record['row_id']))
+            language = self.session.query(tables.Language).get(
+                self._language_ids[record['language']])
 
             results.append(LookupResult(object=obj,
                                         indexed_name=record['name'],
                                         name=record['display_name'],
-                                        language=languages[record['language']],
+                                        language=language,
                                         iso639=record['iso639'],
                                         iso3166=record['iso3166'],
                                         exact=exact))
 
         return results
 
+    def _load_objects(self, records):
+        """Fetches the database objects for some whoosh records.
+
+        Returns a dict of (table name, row id) => object.
+        """
+        objects = {}
+        row_ids_by_table = {}
+        for record in records:
+            key = record['table'], record['row_id']
+            if key in objects:
+                continue
+
+            # Reuse rows the session has already loaded, names and all
+            cls = self.indexed_tables[record['table']]
+            obj = self.session.identity_map.get(
+                identity_key(cls, int(record['row_id'])))
+            if obj is not None:
+                state = inspect(obj)
+                if not state.expired and (
+                        not hasattr(cls, 'names_local') or
+                        'names_local' in state.dict):
+                    objects[key] = obj
+                    continue
+
+            row_ids_by_table.setdefault(record['table'], set()).add(
+                int(record['row_id']))
+
+        # Fetch the rest of each table's rows with a single query, names
+        # included
+        for table_name, row_ids in row_ids_by_table.items():
+            cls = self.indexed_tables[table_name]
+            q = self.session.query(cls).filter(cls.id.in_(row_ids))
+            if hasattr(cls, 'names_local'):
+                q = q.options(joinedload(cls.names_local))
+            for obj in q:
+                objects[table_name, text_type(obj.id)] = obj
+
+        return objects
+
     def _get_current_locale(self):
         """Returns the session's current default language, as an ORM row."""
         return self.session.query(tables.Language).get(
@@ -435,19 +1063,54 @@ class PokedexLookup(object):
             If True, only exact matches are returned.  If set to False (the
             default), and the provided `name` doesn't match anything exactly,
             spelling correction will be attempted.
+
+        If the lookup was created with a `cache_size`, the index records found
+        for each query are remembered in `lookup_cache`.  Database objects are
+        not cached, since they belong to a session; they're fetched again,
+        reusing any the session already has loaded.
         """
 
-        name = self.normalize_name(input)
-        exact = True
+        normalized_input = self.normalize_name(input)
 
         # Pop off any type prefix and merge with valid_types
         name, merged_valid_types, type_term = \
-            self._apply_valid_types(name, valid_types)
+            self._apply_valid_types(normalized_input, valid_types)
 
         # Random lookup
         if name == 'random':
             return self.random_lookup(valid_types=merged_valid_types)
 
+        if self.lookup_cache is None:
+            found = self._lookup_records(name, type_term, exact_only)
+        else:
+            self._check_index_generation()
+            key = self._lookup_cache_key(
+                normalized_input, valid_types, exact_only)
+            found = self.lookup_cache.get(key)
+            if found is None:
+                found = self._lookup_records(name, type_term, exact_only)
+                self.lookup_cache.put(key, found)
+        records, exact, max_results = found
+
+        ### Convert results to db objects, then truncate and return
+        objects = self._whoosh_records_to_results(records, exact=exact)
+        return objects[:max_results]
+
+    def _lookup_records(self, name, type_term, exact_only):
+        """Does the searching for `lookup()`.
+
+        Returns a tuple of the matching index records as a list of dicts,
+        whether they're exact matches, and how many results to return.
+        """
+        locale = self._get_current_locale()
+        with self._searcher() as searcher:
+            return self._search_records(
+                searcher, locale, name, type_term, exact_only)
+
+    def _lookup_query(self, name, exact_only):
+        """Returns the query for a `lookup()` of `name`, whether only exact
+        matches are wanted, and the number of results to return.
+        """
         # Do different things depending what the query looks like
         # Note: Term objects do an exact match, so we don't have to worry about
         # a query parser tripping on weird characters in the input
@@ -469,11 +1132,6 @@ class PokedexLookup(object):
             # Not an integer
             query = whoosh.query.Term(u'name', name)
 
-        if type_term:
-            query = query & type_term
-
-
-        ### Actual searching
         # Limits; result limits are constants, and intermediate results (before
         # duplicate items are stripped out) are capped at the result limit
         # times another constant.
@@ -485,49 +1143,172 @@ class PokedexLookup(object):
         else:
             max_results = self.MAX_FUZZY_RESULTS
 
-        locale = self._get_current_locale()
-        facet = whoosh.sorting.MultiFacet([
+        return query, exact_only, max_results
+
+    def _lookup_facet(self, locale):
+        """Returns the facet `lookup()` sorts exact matches by."""
+        return whoosh.sorting.MultiFacet([
             LanguageFacet(locale.identifier),
             table_facet,
             "name",
         ])
-        searcher = self.index.searcher()
+
+    def _search_records(self, searcher, locale, name, type_term, exact_only):
+        """Searches for `name` with an open searcher, as `_lookup_records()`.
+        """
+        query, exact_only, max_results = self._lookup_query(name, exact_only)
+        if type_term:
+            query = query & type_term
+
         results = searcher.search(
             query,
             limit=int(max_results * self.INTERMEDIATE_FACTOR),
-            sortedby=facet,
+            sortedby=self._lookup_facet(locale),
         )
 
         # Look for some fuzzy matches if necessary
         if not exact_only and not results:
-            exact = False
-            results = []
+            return self._fuzzy_records(
+                searcher, locale, name, type_term, max_results)
 
-            fuzzy_query_parts = []
-            fuzzy_weights = {}
-            corrector = searcher.corrector('name')
-            for suggestion in corrector.suggest(name, limit=max_results):
-                fuzzy_query_parts.append(whoosh.query.Term('name', suggestion))
-                distance = levenshtein.relative(name, suggestion)
-                fuzzy_weights[suggestion] = distance
+        # Stored fields are read lazily, so copy them out while the searcher
+        # is still open
+        records = [dict(record) for record in results]
+        return records, True, max_results
 
-            if not fuzzy_query_parts:
-                # Nothing at all; don't try querying
-                return []
+    def _fuzzy_records(self, searcher, locale, name, type_term, max_results):
+        """Searches for spelling corrections of `name`, for a `lookup()`
+        that found nothing exact.
+        """
+        fuzzy_query_parts = []
+        fuzzy_weights = {}
+        corrector = self._get_corrector(searcher)
+        for suggestion in corrector.suggest(name, limit=max_results):
+            fuzzy_query_parts.append(whoosh.query.Term('name', suggestion))
+            distance = levenshtein.relative(name, suggestion)
+            fuzzy_weights[suggestion] = distance
+
+        if not fuzzy_query_parts:
+            # Nothing at all; don't try querying
+            return [], False, max_results
+
+        fuzzy_query = whoosh.query.Or(fuzzy_query_parts)
+        if type_term:
+            fuzzy_query = fuzzy_query & type_term
 
-            fuzzy_query = whoosh.query.Or(fuzzy_query_parts)
-            if type_term:
-                fuzzy_query = fuzzy_query & type_term
+        sorter = LanguageFacet(locale.identifier, extra_weights=fuzzy_weights)
+        results = searcher.search(fuzzy_query, sortedby=sorter)
+        records = [dict(record) for record in results]
+        return records, False, max_results
 
-            sorter = LanguageFacet(
-                locale.identifier, extra_weights=fuzzy_weights)
-            results = searcher.search(fuzzy_query, sortedby=sorter)
+    def lookup_many(self, inputs, valid_types=[], exact_only=False):
+        """Looks up several names at once.
 
-        ### Convert results to db objects
-        objects = self._whoosh_records_to_results(results, exact=exact)
+        Returns a list with the results of `lookup()` for each of `inputs`, in
+        the same order.  This is much faster than calling `lookup()` in a loop:
+        repeated names are only searched for once, plain names are all matched
+        by a single query, only the names without an exact match are spell
+        checked, and the database objects are fetched together.
 
-        # Truncate and return
-        return objects[:max_results]
+        `valid_types` and `exact_only` apply to every name, as in `lookup()`.
+        """
+        # Normalized input => (name, merged valid types, type term)
+        parsed = {}
+        # Normalized input => (records, exact, max results)
+        found = {}
+        normalized_inputs = [self.normalize_name(input) for input in inputs]
+        if self.lookup_cache is not None:
+            self._check_index_generation()
+        for normalized_input in normalized_inputs:
+            if normalized_input in parsed:
+                continue
+            parsed[normalized_input] = self._apply_valid_types(
+                normalized_input, valid_types)
+            if self.lookup_cache is not None:
+                cached = self.lookup_cache.get(self._lookup_cache_key(
+                    normalized_input, valid_types, exact_only))
+                if cached is not None:
+                    found[normalized_input] = cached
+
+        to_search = [
+            normalized_input
+            for normalized_input, (name, _, _) in parsed.items()
+            if name != 'random' and normalized_input not in found
+        ]
+        if to_search:
+            locale = self._get_current_locale()
+            facet = self._lookup_facet(locale)
+            with self._searcher() as searcher:
+                # Plain names with the same type restriction are matched by
+                # one query, and sorted out afterwards by the name they hit
+                plain_names = {}
+                for normalized_input in to_search:
+                    name, _, type_term = parsed[normalized_input]
+                    query, _, _ = self._lookup_query(name, exact_only)
+                    if (isinstance(query, whoosh.query.Term) and
+                            query.fieldname == u'name'):
+                        plain_names.setdefault(type_term, []).append(
+                            normalized_input)
+                    else:
+                        found[normalized_input] = self._search_records(
+                            searcher, locale, name, type_term, exact_only)
+
+                if exact_only:
+                    max_results = self.MAX_EXACT_RESULTS
+                else:
+                    max_results = self.MAX_FUZZY_RESULTS
+                limit = int(max_results * self.INTERMEDIATE_FACTOR)
+                for type_term, group in plain_names.items():
+                    names = set(parsed[normalized_input][0]
+                                for normalized_input in group)
+                    query = whoosh.query.Or([whoosh.query.Term(u'name', name)
+                                             for name in sorted(names)])
+                    if type_term:
+                        query = query & type_term
+
+                    records_by_name = dict((name, []) for name in names)
+                    for record in searcher.search(
+                            query, limit=None, sortedby=facet):
+                        records = records_by_name[record['name']]
+                        if len(records) < limit:
+                            records.append(dict(record))
+
+                    for normalized_input in group:
+                        name = parsed[normalized_input][0]
+                        if records_by_name[name] or exact_only:
+                            found[normalized_input] = (
+                                records_by_name[name], True, max_results)
+                        else:
+                            found[normalized_input] = self._fuzzy_records(
+                                searcher, locale, name, type_term,
+                                max_results)
+
+            if self.lookup_cache is not None:
+                for normalized_input in to_search:
+                    self.lookup_cache.put(
+                        self._lookup_cache_key(
+                            normalized_input, valid_types, exact_only),
+                        found[normalized_input])
+
+        ### Convert every result to db objects at once
+        objects = self._load_objects(
+            record for records, _, _ in found.values() for record in records)
+
+        results = []
+        for normalized_input in normalized_inputs:
+            name, merged_valid_types, _ = parsed[normalized_input]
+            if name == 'random':
+                results.append(
+                    self.random_lookup(valid_types=merged_valid_types))
+                continue
+            records, exact, max_results = found[normalized_input]
+            results.append(self._whoosh_records_to_results(
+                records, exact=exact, objects=objects)[:max_results])
+        return results
+
+    def _lookup_cache_key(self, normalized_input, valid_types, exact_only):
+        return (normalized_input, tuple(valid_types), exact_only,
+                self.session.default_language_id)
 
 
     def random_lookup(self, valid_types=[]):
@@ -541,7 +1322,8 @@ class PokedexLookup(object):
             # Skip anything not recognized.  Could be, say, a language code.
             # XXX The vast majority of Pokémon forms are unnamed and unindexed,
             #     which can produce blank results.  So skip them too for now.
-            if table_name and table_name != 'pokemon_forms':
+            if (table_name and table_name != 'pokemon_forms' and
+                    table_name not in table_names):
                 table_names.append(table_name)
 
         if not table_names:
@@ -551,25 +1333,50 @@ class PokedexLookup(object):
             table_names = list(self.indexed_tables)
             table_names.remove('pokemon_forms')
 
-        # Pick a random table, then pick a random item from it.  Small tables
-        # like Type will have an unnatural bias.  The alternative is that a
-        # simple search for "random" will do some eight queries, counting the
-        # rows in every single indexed table, and that's awful.
-        # XXX Can we improve on this, reasonably?
-        table_name = random.choice(table_names)
-        count = self.session.query(self.indexed_tables[table_name]).count()
-        id, = self.session.query(self.indexed_tables[table_name].id) \
-            .offset(random.randint(0, count - 1)) \
-            .first()
+        # Pick uniformly among every indexed row of the allowed tables, so
+        # small tables like Type don't get an unnatural bias
+        random_ids = self._get_random_ids()
+        n = random.randrange(sum(len(random_ids[table_name])
+                                 for table_name in table_names))
+        for table_name in table_names:
+            ids = random_ids[table_name]
+            if n < len(ids):
+                break
+            n -= len(ids)
+        id = ids[n]
 
         return self.lookup(text_type(id), valid_types=[table_name])
 
-    def prefix_lookup(self, prefix, valid_types=[]):
+    def _get_random_ids(self):
+        """Returns a dict of table name => list of the ids of that table's
+        indexed rows, read from the index on first use.
+        """
+        if self._random_ids is not None:
+            self._check_index_generation()
+        if self._random_ids is None:
+            random_ids = {}
+            with self._searcher() as searcher:
+                for table_name in self.indexed_tables:
+                    records = searcher.search(
+                        whoosh.query.Term(u'table', text_type(table_name)),
+                        limit=None)
+                    random_ids[table_name] = sorted(set(
+                        int(record['row_id']) for record in records))
+            self._random_ids = random_ids
+        return self._random_ids
+
+    def prefix_lookup(self, prefix, valid_types=[], limit=None):
         """Returns terms starting with the given exact prefix.
 
         Type prefixes are recognized, but no other name munging is done.
+
+        At most `limit` results are returned; the default is
+        `MAX_PREFIX_RESULTS`.
         """
 
+        if limit is None:
+            limit = self.MAX_PREFIX_RESULTS
+
         # Pop off any type prefix and merge with valid_types
         prefix, merged_valid_types, type_term = \
             self._apply_valid_types(prefix, valid_types)
@@ -580,8 +1387,76 @@ class PokedexLookup(object):
             query = query & type_term
 
         locale = self._get_current_locale()
-        searcher = self.index.searcher()
         facet = LanguageFacet(locale.identifier)
-        results = searcher.search(query, sortedby=facet)  # XXX , limit=self.MAX_LOOKUP_RESULTS)
+        with self._searcher() as searcher:
+            results = searcher.search(query, limit=limit, sortedby=facet)
+
+            return self._whoosh_records_to_results(results)
+
+    def autocomplete(self, prefix, valid_types=[], limit=10):
+        """Suggests up to `limit` names starting with `prefix`, best first.
+        Meant for completing names as they're typed.
+
+        Type and language prefixes are recognized, as with `lookup()`.  Each
+        object is suggested once, under its best name for the current locale.
+
+        Returns a list of `AutocompleteResult` tuples, built from the index
+        alone without touching the database.  Recent answers are kept in
+        `autocomplete_cache`, which is cleared whenever the index changes.
+        """
+
+        self._check_index_generation()
+        key = (self.normalize_name(prefix), tuple(valid_types),
+               self.session.default_language_id, limit)
+        results = self.autocomplete_cache.get(key)
+        if results is None:
+            results = self._autocomplete(key[0], valid_types, limit)
+            self.autocomplete_cache.put(key, results)
+        return list(results)
 
-        return self._whoosh_records_to_results(results)
+    def _autocomplete(self, prefix, valid_types, limit):
+        prefix, merged_valid_types, type_term = \
+            self._apply_valid_types(prefix, valid_types)
+
+        query = whoosh.query.Prefix(u'name', prefix)
+        if type_term:
+            query = query & type_term
+
+        facet = self._lookup_facet(self._get_current_locale())
+
+        # Names repeat across languages, so more records than `limit` are
+        # needed; read more until there are enough distinct objects or none
+        # are left
+        fetch_limit = int(limit * self.INTERMEDIATE_FACTOR)
+        with self._searcher() as searcher:
+            while True:
+                records = searcher.search(
+                    query, limit=fetch_limit, sortedby=facet)
+
+                seen = set()
+                results = []
+                for record in records:
+                    # Skip dupes
+                    seen_key = record['table'], record['row_id']
+                    if seen_key in seen:
+                        continue
+                    seen.add(seen_key)
+
+                    results.append(AutocompleteResult(
+                        name=record['display_name'],
+                        indexed_name=record['name'],
+                        table=record['table'],
+                        row_id=int(record['row_id']),
+                        language=record['language'],
+                        iso639=record['iso639'],
+                        iso3166=record['iso3166'],
+                    ))
+                    if len(results) >= limit:
+                        break
+
+                # Both backends' results count every match, fetched or not
+                if len(results) >= limit or len(records) < fetch_limit:
+                    break
+                fetch_limit *= 2
+
+        return results
@@ -46,6 +46,16 @@ def create_parser():
             u'POKEDEX_INDEX_DIR environment variable) to specify an '
             u'alternate loction.',
     )
+    common_parser.add_argument(
+        '--pool-size', dest='pool_size', type=int, default=None,
+        help=u'Number of database connections to keep open, for '
+            u'databases that pool them.',
+    )
+    common_parser.add_argument(
+        '--pool-pre-ping', dest='pool_pre_ping', action='store_true',
+        help=u'Check that pooled database connections are still alive '
+            u'before using them.',
+    )
     common_parser.add_argument(
         '-q', '--quiet', dest='verbose', action='store_false',
         help=u'Don\'t print system output.  This is the default for '
@@ -95,7 +105,17 @@ def create_parser():
         help="load and drop all dependent tables (default is to use exactly the given list)")
     cmd_load.add_argument(
         '-S', '--safe', dest='safe', default=False, action='store_true',
-        help="disable database-specific optimizations, such as Postgres's COPY FROM")
+        help="disable database-specific optimizations, such as Postgres's COPY FROM "
+            "or MySQL's LOAD DATA")
+    cmd_load.add_argument(
+        '-j', '--jobs', dest='workers', default=1, type=int,
+        help="number of tables to load at once, each over its own connection (default: 1)")
+    cmd_load.add_argument(
+        '-I', '--incremental', dest='incremental', default=False, action='store_true',
+        help="only reload tables whose CSV files changed since the last load, and their dependents")
+    cmd_load.add_argument(
+        '--defer-indexes', dest='defer_indexes', default=None, action='store_true',
+        help="create indexes and foreign keys after loading the data (default for SQLite without --safe)")
     # TODO need a custom handler for splittin' all of these
     cmd_load.add_argument(
         '-l', '--langs', dest='langs', default=None,
@@ -114,6 +134,9 @@ def create_parser():
     cmd_dump.add_argument(
         '-l', '--langs', dest='langs', default=None,
         help="comma-separated list of language codes to load, 'none', or 'all' (default: en)")
+    cmd_dump.add_argument(
+        '-j', '--jobs', dest='workers', default=1, type=int,
+        help="number of tables to dump at once, each over its own connection (default: 1)")
     cmd_dump.add_argument(
         'tables', nargs='*',
         help="list of database tables to load (default: all)")
@@ -122,11 +145,31 @@ def create_parser():
         'reindex', help=u'Rebuild the lookup index from the database',
         parents=[common_parser])
     cmd_reindex.set_defaults(func=command_reindex, verbose=True)
+    cmd_reindex.add_argument(
+        '-j', '--jobs', dest='workers', default=1, type=int,
+        help="number of processes writing the index, each to its own segment (default: 1)")
+    cmd_reindex.add_argument(
+        '-I', '--incremental', dest='incremental', default=False, action='store_true',
+        help="only reindex tables whose names changed since the last reindex")
 
     cmd_setup = cmds.add_parser(
         'setup', help=u'Combine load and reindex',
         parents=[common_parser])
     cmd_setup.set_defaults(func=command_setup, verbose=False)
+    cmd_setup.add_argument(
+        '-j', '--jobs', dest='workers', default=1, type=int,
+        help="number of tables to load at once, each over its own connection (default: 1)")
+
+    cmd_build = cmds.add_parser(
+        'build', help=u'Build a prebuilt SQLite database for a quick setup',
+        parents=[common_parser])
+    cmd_build.set_defaults(func=command_build, verbose=True)
+    cmd_build.add_argument(
+        '-o', '--output', dest='output', default=None,
+        help=u'where to put the database.  By default, this is a file in '
+            u'the pokedex install directory, where `pokedex setup` looks '
+            u'for it.  Use this option (or a POKEDEX_SQLITE_ARTIFACT '
+            u'environment variable) to specify an alternate location.')
 
     cmd_status = cmds.add_parser(
         'status', help=u'Print which engine, index, and csv directory would be used for other commands',
@@ -147,7 +190,8 @@ def get_session(args):
     if engine_uri is None:
         engine_uri, got_from = defaults.get_default_db_uri_with_origin()
 
-    session = pokedex.db.connect(engine_uri)
+    session = pokedex.db.connect(engine_uri, pool_size=args.pool_size,
+                                 pool_pre_ping=args.pool_pre_ping)
 
     if args.verbose:
         print("Connected to database %(engine)s (from %(got_from)s)"
@@ -217,6 +261,7 @@ def command_dump(parser, args):
         tables=args.tables,
         verbose=args.verbose,
         langs=langs,
+        workers=args.workers,
     )
 
 
@@ -247,13 +292,34 @@ def command_load(parser, args):
         safe=args.safe,
         recursive=args.recursive,
         langs=langs,
+        workers=args.workers,
+        incremental=args.incremental,
+        defer_indexes=args.defer_indexes,
     )
 
 
 def command_reindex(parser, args):
     session = get_session(args)
-    get_lookup(args, session=session, recreate=True)
-    print("Recreated lookup index.")
+    lookup = get_lookup(args, session=session, recreate=False)
+    lookup.rebuild_index(workers=args.workers, incremental=args.incremental)
+    if args.incremental:
+        print("Updated lookup index.")
+    else:
+        print("Recreated lookup index.")
+
+
+def command_build(parser, args):
+    args.directory = None
+
+    path = args.output
+    got_from = 'command line'
+    if path is None:
+        path, got_from = defaults.get_default_sqlite_artifact_with_origin()
+
+    get_csv_directory(args)
+    pokedex.db.load.build_sqlite_artifact(path, verbose=args.verbose)
+    print("Built prebuilt database %(path)s (from %(got_from)s)"
+        % dict(path=path, got_from=got_from))
 
 
 def command_setup(parser, args):
@@ -261,9 +327,20 @@ def command_setup(parser, args):
 
     session = get_session(args)
     get_csv_directory(args)
-    pokedex.db.load.load(
-        session, directory=None, drop_tables=True,
-        verbose=args.verbose, safe=False)
+
+    # A prebuilt SQLite database is just as good as a fresh one, as long as
+    # the CSVs haven't changed since it was built
+    artifact = defaults.get_default_sqlite_artifact()
+    url = session.bind.url
+    if (url.drivername.startswith('sqlite') and url.database
+            and pokedex.db.load.sqlite_artifact_is_current(artifact)):
+        pokedex.db.load.install_sqlite_artifact(artifact, url.database)
+        if args.verbose:
+            print("Copied prebuilt database %s" % artifact)
+    else:
+        pokedex.db.load.load(
+            session, directory=None, drop_tables=True,
+            verbose=args.verbose, safe=False, workers=args.workers)
 
     get_lookup(args, session=session, recreate=True)
     print("Recreated lookup index.")
@@ -303,7 +380,7 @@ def command_status(parser, args):
 
     # Index; the PokedexLookup constructor covers most tests and will
     # cheerfully bomb if they fail
-    get_lookup(args, recreate=False)
+    get_lookup(args, session=session, recreate=False)
     print("  - OK!  Opened successfully.")
 
 
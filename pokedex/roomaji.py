@@ -234,11 +234,27 @@ romanizers['cs'] = Romanizer(parent=romanizers['en'],
     y_drop={u'či': u'č', u'ši': u'š', u'dži': u'dž', u'ni': u'ňj'},
 )
 
+# (language, kana) => roomaji, for everything romanize() has already done.
+# Emptied whenever it fills up
+_romanized = {}
+_ROMANIZED_SIZE = 16384
+
 def romanize(string, lang='en'):
     """Convert a string of kana to roomaji."""
 
+    key = lang, string
+    try:
+        return _romanized[key]
+    except KeyError:
+        pass
+
     # Get the correct romanizer; fall back to English
-    romanizer = romanizers.get(lang, 'en')
+    romanizer = romanizers.get(lang, romanizers['en'])
 
     # Romanize away!
-    return romanizer.romanize(string)
+    roomaji = romanizer.romanize(string)
+
+    if len(_romanized) >= _ROMANIZED_SIZE:
+        _romanized.clear()
+    _romanized[key] = roomaji
+    return roomaji
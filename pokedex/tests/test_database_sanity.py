@@ -1,6 +1,10 @@
+import shutil
+import sqlite3
+
 import pytest
 parametrize = pytest.mark.parametrize
 
+from sqlalchemy import create_engine, orm
 from sqlalchemy.orm import aliased, joinedload, lazyload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import func
@@ -93,3 +97,128 @@ def test_default_forms(session):
             pytest.fail("species %s has no default pokemon" % species.name)
         elif num_default_pokemon > 1:
             pytest.fail("species %s has %d default pokemon" % (species.name, num_default_pokemon))
+
+def test_in_memory_connect(session):
+    """connect(in_memory=True) serves a read-only copy of a SQLite database."""
+    if session.bind.url.get_backend_name() != 'sqlite':
+        pytest.skip("in_memory only works with SQLite")
+    if not hasattr(sqlite3.Connection, 'backup'):
+        with pytest.raises(RuntimeError):
+            connect(str(session.bind.url), in_memory=True)
+        pytest.skip("in_memory needs Python 3.7 or later")
+    memory_session = connect(str(session.bind.url), in_memory=True)
+    eevee = util.get(memory_session, tables.PokemonSpecies, u'eevee')
+    assert eevee.name == u'Eevee'
+    with pytest.raises(Exception):
+        memory_session.execute(tables.Language.__table__.delete())
+    memory_session.rollback()
+
+def test_connect_shares_engine(session):
+    """Connecting to the same URI twice reuses the engine."""
+    uri = str(session.bind.url)
+    assert connect(uri).bind is connect(uri).bind
+    assert connect(uri).bind is not connect(uri, pool_pre_ping=True).bind
+
+def test_translation_cache(session, count_queries):
+    """Translations read from the cache match the ones in the database."""
+    from pokedex.db.multilang import translation_cache
+    translation_cache.clear()
+    cached_session = connect(str(session.bind.url), cache_translations=True)
+    assert cached_session.translation_cache is translation_cache
+    Names = tables.PokemonSpecies.names_table
+
+    for language_id in (1, 5, 9):
+        cached_session.default_language_id = language_id
+        for id in (1, 133, 493):
+            rows = session.query(Names).filter_by(pokemon_species_id=id).all()
+            cached = cached_session.query(tables.PokemonSpecies).get(id)
+            local_row, = [row for row in rows
+                          if row.local_language_id == language_id]
+            assert cached.name == local_row.name
+            assert cached.genus == local_row.genus
+            assert dict((language.id, name)
+                        for language, name in cached.name_map.items()) == \
+                dict((row.local_language_id, row.name) for row in rows)
+        cached_session.expire_all()
+
+    # Texts are never looked up again
+    with count_queries(cached_session.bind) as queries:
+        cached.name
+        cached.name_map
+    assert queries == []
+
+def test_translation_cache_per_database(session, tmpdir):
+    """Sessions on different databases don't share cached translations."""
+    from pokedex.db.multilang import MultilangSession, translation_cache
+    if session.bind.dialect.name != 'sqlite':
+        pytest.skip("needs a copy of a SQLite database")
+    translation_cache.clear()
+    path = str(tmpdir.join('renamed.sqlite'))
+    shutil.copyfile(session.bind.url.database, path)
+    renamed_engine = create_engine('sqlite:///' + path)
+    renamed_engine.execute("UPDATE pokemon_species_names SET name = 'Bulby' "
+                           "WHERE pokemon_species_id = 1 "
+                           "AND local_language_id = 9")
+
+    def cached_species(bind):
+        cached_session = orm.sessionmaker(class_=MultilangSession, bind=bind,
+            default_language_id=9, translation_cache=translation_cache)()
+        return cached_session.query(tables.PokemonSpecies).get(1).name
+
+    try:
+        assert cached_species(session.bind) == u'Bulbasaur'
+        assert cached_species(renamed_engine) == u'Bulby'
+        assert cached_species(session.bind) == u'Bulbasaur'
+    finally:
+        translation_cache.clear()
+        renamed_engine.dispose()
+
+def test_with_translations(session, count_queries):
+    """with_translations() loads every object's texts up front."""
+    session.expire_all()
+    moves = session.query(tables.Move).order_by(tables.Move.id) \
+        .limit(20).with_translations().all()
+    with count_queries(session.bind) as queries:
+        assert moves[0].name == u'Pound'
+        names = [move.name for move in moves]
+    assert queries == []
+    assert None not in names
+
+    session.expire_all()
+    rows = session.query(tables.Move, tables.Type).join(tables.Move.type) \
+        .filter(tables.Move.id == 1).with_translations(u'ja', u'fr').all()
+    (move, type_), = rows
+    ja = util.get(session, tables.Language, u'ja')
+    fr = util.get(session, tables.Language, u'fr')
+    with count_queries(session.bind) as queries:
+        name_map = dict((language.identifier, move.name_map[language])
+                        for language in (ja, fr))
+        type_name = type_.name_map.get(fr)
+    assert queries == []
+    assert name_map == {u'ja': u'はたく', u'fr': u"Écras'Face"}
+    assert type_name == u'Normal'
+
+    # The other languages are still there, and the full names are loaded
+    # for them as usual
+    assert u'en' in [language.identifier for language in type_.name_map]
+    assert type_.name_map[util.get(session, tables.Language, u'en')] == (
+        u'Normal')
+
+    # An already loaded collection isn't cut down to the languages asked for
+    session.query(tables.Type).filter(tables.Type.id == type_.id) \
+        .with_translations(u'ja').all()
+    assert len(type_.names) > 2
+
+def test_using_language(session):
+    """using_language() switches languages, and switches back afterwards."""
+    french = util.get(session, tables.Language, u'fr')
+    species = session.query(tables.PokemonSpecies).get(1)
+    assert species.name == u'Bulbasaur'
+    with session.using_language(french):
+        assert session.default_language_id == french.id
+        assert species.name == u'Bulbizarre'
+        # Lazy loads of objects fetched inside get the language too
+        assert session.query(tables.Type).get(2).name == u'Combat'
+        assert species.genus == u'Graine'
+    assert session.default_language_id == 9
+    assert species.name == u'Bulbasaur'
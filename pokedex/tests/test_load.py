@@ -0,0 +1,250 @@
+# Encoding: UTF-8
+
+import os
+import shutil
+import threading
+import time
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+from pokedex.db import metadata, load
+from pokedex.db.dependencies import compute_dependencies
+from pokedex.defaults import get_default_csv_dir
+
+
+def test_run_in_dependency_order():
+    table_objs = list(metadata.sorted_tables)
+    graph = compute_dependencies(table_objs)
+
+    finished = []
+    lock = threading.Lock()
+    def func(table):
+        # Give other workers a chance to jump the queue
+        time.sleep(0.001)
+        with lock:
+            finished.append(table)
+        return table.name
+
+    results = load._run_in_dependency_order(table_objs, func, 4)
+
+    assert sorted(finished, key=id) == sorted(table_objs, key=id)
+    assert all(results[table] == table.name for table in table_objs)
+    for parent, children in graph.items():
+        for child in children:
+            if child is not parent:
+                assert finished.index(parent) < finished.index(child)
+
+def test_run_in_dependency_order_error():
+    table_objs = list(metadata.sorted_tables)
+    def func(table):
+        if table.name == 'languages':
+            raise KeyError(table.name)
+
+    with pytest.raises(KeyError):
+        load._run_in_dependency_order(table_objs, func, 4)
+
+def test_critical_path():
+    tables = metadata.tables
+    table_objs = [tables['languages'], tables['generations'],
+                  tables['generation_names']]
+    timings = {
+        tables['languages']: 1.0,
+        tables['generations']: 3.0,
+        tables['generation_names']: 0.5,
+    }
+    total, path = load._critical_path(table_objs, timings)
+    assert total == 3.5
+    assert path == [tables['generations'], tables['generation_names']]
+
+def test_row_converter():
+    table = metadata.tables['pokemon_species']
+    columns = ['id', 'identifier', 'evolves_from_species_id',
+               'is_baby', 'has_gender_differences', 'conquest_order']
+    convert_row = load._make_row_converter(table, columns)
+
+    row = convert_row(['133', 'eevee', '', '0', '1', ''])
+    assert row == dict(
+        id=133,
+        identifier='eevee',
+        evolves_from_species_id=None,
+        is_baby=False,
+        has_gender_differences=True,
+        conquest_order=None,
+    )
+
+def test_hash_csv_files(tmpdir):
+    engine = sqlalchemy.create_engine('sqlite://')
+    tmpdir.join('regions.csv').write('id,identifier\n1,kanto\n')
+    tmpdir.mkdir('translations').join('cs.csv').write(
+        'language_id,table,id,column,source_crc,string\n'
+        '10,Region,1,name,,Kanto\n'
+        '10,Move,1,name,,Liska\n'
+    )
+    table_objs = [metadata.tables['regions'], metadata.tables['region_names'],
+                  metadata.tables['pokemon_moves']]
+
+    hashes = load._hash_csv_files(table_objs, str(tmpdir), engine)
+    assert set(hashes['regions']) == set(['regions.csv'])
+    assert set(hashes['region_names']) == set(
+        ['translations/cs.csv', 'translations/:languages'])
+    assert hashes['pokemon_moves'] == {}
+
+    # Loading other languages is a change too
+    cs_hashes = load._hash_csv_files(table_objs, str(tmpdir), engine, ['cs'])
+    assert cs_hashes['regions'] == hashes['regions']
+    assert cs_hashes['region_names'] != hashes['region_names']
+
+    tmpdir.join('translations', 'cs.csv').write(
+        'language_id,table,id,column,source_crc,string\n'
+        '10,Region,1,name,,Kanto!\n'
+    )
+    new_hashes = load._hash_csv_files(table_objs, str(tmpdir), engine)
+    assert new_hashes['regions'] == hashes['regions']
+    assert new_hashes['region_names'] != hashes['region_names']
+
+def make_csv_dir(tmpdir, names):
+    """Copies the named CSV files, and a Czech name for an egg group, into a
+    new directory under `tmpdir`.
+    """
+    source_dir = get_default_csv_dir()
+    csv_dir = tmpdir.mkdir('csv')
+    for name in ['languages'] + names:
+        shutil.copy(os.path.join(source_dir, name + '.csv'), str(csv_dir))
+    csv_dir.mkdir('translations').join('cs.csv').write_binary(
+        u'language_id,table,id,column,source_crc,string\n'
+        u'10,EggGroup,1,name,ebe3ff68,pozemní\n'.encode('utf-8'))
+    return csv_dir
+
+def test_incremental_load(tmpdir, monkeypatch):
+    csv_dir = make_csv_dir(tmpdir, ['egg_groups', 'egg_group_prose',
+        'move_battle_styles', 'move_battle_style_prose'])
+
+    loaded = []
+    load_table = load._load_table
+    def record_load_table(session, table, *args, **kwargs):
+        loaded.append(table.name)
+        return load_table(session, table, *args, **kwargs)
+    monkeypatch.setattr(load, '_load_table', record_load_table)
+
+    # Not connect(); that would rebind the metadata
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmpdir.join('db')))
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    def load_csvs(**kwargs):
+        del loaded[:]
+        load.load(session, tables=['egg_groups', 'move_battle_styles'],
+                  directory=str(csv_dir), **kwargs)
+        return set(loaded)
+
+    all_tables = set([
+        'egg_groups', 'egg_group_prose', 'pokemon_egg_groups',
+        'move_battle_styles', 'move_battle_style_prose',
+        'nature_battle_style_preferences'])
+    # A plain load doesn't start a manifest...
+    assert load_csvs(drop_tables=True, langs=[]) == all_tables
+    assert not load.manifest_table.exists(bind=engine)
+    # ...so the first incremental load has nothing to compare with
+    assert load_csvs(incremental=True, langs=[]) == all_tables
+    assert load_csvs(incremental=True, langs=[]) == set()
+
+    # Only the changed table and its dependents are reloaded
+    egg_groups = csv_dir.join('egg_groups.csv')
+    egg_groups.write(egg_groups.read().replace('1,monster\n', '1,monstrous\n'))
+    assert load_csvs(incremental=True, langs=[]) == set(
+        ['egg_groups', 'egg_group_prose', 'pokemon_egg_groups'])
+    assert engine.execute("SELECT identifier FROM egg_groups WHERE id = 1"
+                          ).scalar() == u'monstrous'
+
+    # So are tables with translations, once other languages are asked for
+    assert load_csvs(incremental=True) == set(['egg_group_prose'])
+    assert load_csvs(incremental=True) == set()
+    session.close()
+    engine.dispose()
+
+def test_create_bare_table():
+    engine = sqlalchemy.create_engine('sqlite://')
+    table = metadata.tables['pokemon_species']
+    assert table.indexes
+
+    load._create_bare_table(table, engine)
+    inspector = sqlalchemy.inspect(engine)
+    assert inspector.get_indexes('pokemon_species') == []
+    assert inspector.get_foreign_keys('pokemon_species')
+
+    for index in table.indexes:
+        index.create(bind=engine)
+    inspector = sqlalchemy.inspect(engine)
+    assert len(inspector.get_indexes('pokemon_species')) == len(table.indexes)
+
+def test_dump_table(tmpdir):
+    engine = sqlalchemy.create_engine('sqlite://')
+    table = metadata.tables['regions']
+    table.create(bind=engine)
+    engine.execute(table.insert(), [
+        dict(id=2, identifier=u'johto'),
+        dict(id=1, identifier=u'kanto'),
+    ])
+    filename = str(tmpdir.join('regions.csv'))
+
+    result = load._dump_table(engine.connect(), table, filename)
+    assert tmpdir.join('regions.csv').read() == 'id,identifier\n1,kanto\n2,johto\n'
+    assert result == (2, len('id,identifier\n1,kanto\n2,johto\n'))
+    assert tmpdir.listdir() == [tmpdir.join('regions.csv')]
+
+    # Replacing a file keeps its permissions
+    os.chmod(filename, 0o640)
+    load._dump_table(engine.connect(), table, filename)
+    assert os.stat(filename).st_mode & 0o777 == 0o640
+    assert tmpdir.listdir() == [tmpdir.join('regions.csv')]
+
+def test_dump_workers(session, tmpdir):
+    tables = ['regions', 'region_names', 'types', 'type_names', 'stats']
+    serial_dir = tmpdir.mkdir('serial')
+    parallel_dir = tmpdir.mkdir('parallel')
+
+    serial = load.dump(session, tables=tables, directory=str(serial_dir))
+    parallel = load.dump(session, tables=tables, directory=str(parallel_dir),
+                         workers=2)
+    assert parallel == serial
+    assert sorted(path.basename for path in parallel_dir.listdir()) == \
+        sorted(table + '.csv' for table in tables)
+    for table in tables:
+        filename = table + '.csv'
+        assert parallel_dir.join(filename).read_binary() == \
+            serial_dir.join(filename).read_binary()
+
+def test_sqlite_artifact(tmpdir):
+    csv_dir = make_csv_dir(tmpdir, ['regions', 'egg_groups'])
+    path = str(tmpdir.join('prebuilt.sqlite'))
+    database_path = str(tmpdir.join('pokedex.sqlite'))
+    bind = metadata.bind
+
+    load.build_sqlite_artifact(path, directory=str(csv_dir))
+    assert metadata.bind is bind
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        'csv', 'prebuilt.sqlite']
+    assert load.sqlite_artifact_is_current(path, directory=str(csv_dir))
+
+    load.install_sqlite_artifact(path, database_path)
+    engine = sqlalchemy.create_engine('sqlite:///' + database_path)
+    assert engine.execute("SELECT identifier FROM regions WHERE id = 1"
+                          ).scalar() == u'kanto'
+    engine.dispose()
+
+    csv_dir.join('regions.csv').write('id,identifier\n1,kanto\n')
+    assert not load.sqlite_artifact_is_current(path, directory=str(csv_dir))
+
+def test_sqlite_artifact_is_current(tmpdir):
+    version = load._sqlite_schema_version()
+    assert version == load._sqlite_schema_version()
+    assert 0 <= version < 2 ** 31
+
+    path = str(tmpdir.join('prebuilt.sqlite'))
+    assert not load.sqlite_artifact_is_current(path)
+
+    # Right schema, but no manifest
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    engine.execute("PRAGMA user_version = %d" % version)
+    engine.dispose()
+    assert not load.sqlite_artifact_is_current(path)
@@ -3,6 +3,11 @@
 import pytest
 parametrize = pytest.mark.parametrize
 
+def summarize(results):
+    """Boils lookup results down to comparable tuples."""
+    return [(result.object.__tablename__, result.object.id, result.name,
+             result.exact) for result in results]
+
 @parametrize(
     ('input', 'table', 'id'),
     [
@@ -128,6 +133,17 @@ def test_wildcard_lookup(lookup, wildcard, name):
     assert first_result.object.name == name
 
 
+def test_wildcard_objects(lookup):
+    """Each of many wildcard matches comes back with its own object."""
+    results = lookup.lookup(u'pokemon:p*')
+    assert len(results) > 10
+    for result in results:
+        assert result.object.__tablename__ in ('pokemon_species',
+                                               'pokemon_forms')
+        if result.language.identifier == u'en':
+            assert result.object.name == result.name
+
+
 def test_bare_random(lookup):
     for i in range(5):
         results = lookup.lookup(u'random')
@@ -150,7 +166,288 @@ def test_qualified_random(lookup, table_name):
     assert results[0].object.__tablename__ == table_name
 
 
+def test_random_ids(lookup):
+    """Random lookups pick from the ids in the index."""
+    random_ids = lookup._get_random_ids()
+    assert 133 in random_ids['pokemon_species']
+    for i in range(5):
+        results = lookup.random_lookup(valid_types=['type', 'types'])
+        assert results[0].object.id in random_ids['types']
+
+
 def test_crash_empty_prefix(lookup):
     """Searching for ':foo' used to crash, augh!"""
     results = lookup.lookup(u':Eevee')
     assert results[0].object.name == u'Eevee'
+
+
+def test_searcher_reuse(lookup):
+    """Lookups keep reusing one searcher, until the lookup is closed."""
+    lookup.lookup(u'Eevee')
+    searcher, = lookup._idle_searchers
+    lookup.lookup(u'Pikachu')
+    assert lookup._idle_searchers == [searcher]
+
+    lookup.close()
+    assert not lookup._idle_searchers
+    assert searcher.is_closed
+    assert lookup.lookup(u'Eevee')[0].object.name == u'Eevee'
+
+
+def test_threaded_lookup(lookup):
+    """One lookup object can be shared among threads."""
+    import threading
+    names = []
+    def worker():
+        names.append(lookup.lookup(u'Eevee')[0].object.name)
+        lookup.session.remove()
+    threads = [threading.Thread(target=worker) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert names == [u'Eevee'] * 4
+
+
+@parametrize(
+    'input',
+    [u'Eevee', u'1', u'@fr:charge', u'pokemon:*meleon', u'ee?ee', u'*',
+     u'chamander', u'Yamikrasu', u'xyzzy']
+)
+def test_memory_backend(lookup, input):
+    """The in-memory backend finds the same things as whoosh."""
+    import os
+    from pokedex.lookup import MemoryIndex, PokedexLookup
+    if not os.path.exists(os.path.join(lookup.directory, MemoryIndex.FILENAME)):
+        pytest.skip("index was built without the in-memory backend")
+    memory_lookup = PokedexLookup(lookup.directory, session=lookup.session,
+                                  backend='memory')
+    assert (summarize(memory_lookup.lookup(input)) ==
+            summarize(lookup.lookup(input)))
+    assert (summarize(memory_lookup.prefix_lookup(input)) ==
+            summarize(lookup.prefix_lookup(input)))
+
+
+@parametrize('prefix', [u'pikachu', u'kl', u'move:th', u'xyzzy'])
+def test_memory_backend_autocomplete(lookup, prefix):
+    """The in-memory backend autocompletes the same things as whoosh."""
+    import os
+    from pokedex.lookup import MemoryIndex, PokedexLookup
+    if not os.path.exists(os.path.join(lookup.directory, MemoryIndex.FILENAME)):
+        pytest.skip("index was built without the in-memory backend")
+    memory_lookup = PokedexLookup(lookup.directory, session=lookup.session,
+                                  backend='memory')
+    for limit in (10, 25):
+        assert (memory_lookup.autocomplete(prefix, limit=limit) ==
+                lookup.autocomplete(prefix, limit=limit))
+
+
+def test_fuzzy_index():
+    from pokedex.lookup import FuzzyIndex
+    fuzzy_index = FuzzyIndex.from_frequencies(
+        {u'eevee': 1, u'evee': 1, u'eve': 3, u'steve': 1, u'vee': 1,
+         u'pikachu': 1})
+    assert sorted(fuzzy_index.within(u'eveee', 1)) == [
+        (u'eevee', 1, 1), (u'evee', 1, 1)]
+    # Transpositions are a single edit
+    assert sorted(fuzzy_index.within(u'pikahcu', 1)) == [(u'pikachu', 1, 1)]
+    # Closest first, then most common, then alphabetical; never the input
+    assert fuzzy_index.suggest(u'evee', limit=3) == [u'eve', u'eevee', u'vee']
+
+
+def test_fuzzy_index_matches_whoosh(lookup):
+    """The fuzzy index suggests exactly what whoosh's corrector does."""
+    import os
+    from pokedex.lookup import FuzzyIndex
+    if not os.path.exists(os.path.join(lookup.directory, FuzzyIndex.FILENAME)):
+        pytest.skip("index was built without a fuzzy index")
+    fuzzy_index = FuzzyIndex.load(lookup.directory)
+    with lookup._searcher() as searcher:
+        corrector = searcher.corrector('name')
+        for misspelling in (u'chamander', u'pokeball', u'yamikrasu', u'evee',
+                            u'pikahcu', u'カクレオ'):
+            assert (fuzzy_index.suggest(misspelling, limit=10) ==
+                    corrector.suggest(misspelling, limit=10))
+
+
+def test_select_names(lookup):
+    """The names read for indexing match the ones the ORM sees."""
+    from pokedex.db import tables
+    names = lookup._select_names()
+    types = lookup.session.query(tables.Type).order_by(tables.Type.id)
+    english_names = [(type_id, name) for type_id, language_id, name
+                     in names['types'] if language_id == 9]
+    assert english_names == [(type.id, type.name) for type in types
+                             if type.name]
+
+
+def small_lookup(session, directory):
+    """Returns a lookup for a fresh index of only types and natures."""
+    from pokedex.db import tables
+    from pokedex.lookup import PokedexLookup
+    lookup = PokedexLookup(str(directory), session=session)
+    lookup.indexed_tables = dict(
+        (cls.__tablename__, cls) for cls in (tables.Type, tables.Nature))
+    return lookup
+
+def index_documents(lookup):
+    with lookup._searcher() as searcher:
+        return sorted(sorted(searcher.stored_fields(docnum).items())
+                      for docnum in searcher.reader().all_doc_ids())
+
+def test_incremental_rebuild(session, tmpdir, monkeypatch):
+    lookup = small_lookup(session, tmpdir)
+    lookup.rebuild_index()
+    documents = index_documents(lookup)
+    files = dict((path.basename, path.read_binary())
+                 for path in tmpdir.listdir())
+
+    # Nothing changed, so nothing is written
+    lookup.rebuild_index(incremental=True)
+    assert dict((path.basename, path.read_binary())
+                for path in tmpdir.listdir()) == files
+
+    # A renamed type replaces that table's documents, and only those
+    select_names = lookup._select_names
+    def renamed_names():
+        names = select_names()
+        names['types'] = [
+            (row_id, language_id, u'Blaze' if name == u'Fire' else name)
+            for row_id, language_id, name in names['types']]
+        return names
+    monkeypatch.setattr(lookup, '_select_names', renamed_names)
+    lookup.rebuild_index(incremental=True)
+
+    result, = lookup.lookup(u'blaze')
+    assert (result.object.identifier, result.exact) == (u'fire', True)
+    assert not lookup.lookup(u'fire')[0].exact
+    assert lookup.lookup(u'adamant')[0].exact
+    new_documents = index_documents(lookup)
+    assert len(new_documents) == len(documents)
+    assert [document for document in new_documents
+            if document not in documents] == [
+        [(u'display_name', u'Blaze'), (u'iso3166', u'us'),
+         (u'iso639', u'en'), (u'language', u'en'), (u'name', u'blaze'),
+         (u'row_id', u'10'), (u'table', u'types')]]
+
+def test_rebuild_elsewhere(session, tmpdir, monkeypatch):
+    """Caches are forgotten when another lookup rebuilds the index."""
+    from pokedex.lookup import PokedexLookup
+    builder = small_lookup(session, tmpdir)
+    builder.rebuild_index()
+    reader = PokedexLookup(str(tmpdir), session=session, cache_size=16)
+    reader.indexed_tables = builder.indexed_tables
+
+    assert reader.lookup(u'fire')[0].exact
+    assert u'Fire' in [result.name for result in reader.autocomplete(u'fir')]
+    assert reader.lookup(u'fyre')[0].object.identifier == u'fire'
+    fuzzy_index = reader._fuzzy_index
+    assert fuzzy_index is not None
+    reader.random_lookup(['type'])
+    assert reader._random_ids is not None
+
+    select_names = builder._select_names
+    def renamed_names():
+        names = select_names()
+        names['types'] = [
+            (row_id, language_id, u'Blaze' if name == u'Fire' else name)
+            for row_id, language_id, name in names['types']]
+        return names
+    monkeypatch.setattr(builder, '_select_names', renamed_names)
+    builder.rebuild_index()
+
+    assert not reader.lookup(u'fire')[0].exact
+    assert u'Fire' not in [
+        result.name for result in reader.autocomplete(u'fir')]
+    assert reader._random_ids is None
+    assert reader.lookup(u'blaz')[0].name == u'Blaze'
+    assert reader._fuzzy_index is not fuzzy_index
+
+def test_rebuild_workers(session, tmpdir):
+    serial_lookup = small_lookup(session, tmpdir.mkdir('serial'))
+    serial_lookup.rebuild_index()
+    parallel_lookup = small_lookup(session, tmpdir.mkdir('parallel'))
+    parallel_lookup.rebuild_index(workers=2)
+    assert index_documents(parallel_lookup) == index_documents(serial_lookup)
+    result = parallel_lookup.lookup(u'fire')[0]
+    assert (result.object.identifier, result.exact) == (u'fire', True)
+
+
+def test_autocomplete(lookup):
+    results = lookup.autocomplete(u'Pika', limit=3)
+    assert len(results) == 3
+    assert results[0].name == u'Pikachu'
+    assert results[0].table == 'pokemon_species'
+    assert results[0].row_id == 25
+
+    assert all(result.table == 'moves'
+               for result in lookup.autocomplete(u'move:th'))
+    assert len(lookup.prefix_lookup(u'p', limit=5)) == 5
+
+
+def test_autocomplete_fills_limit(lookup):
+    # "kl" matches many names in several languages; dupes must not crowd out
+    # distinct objects
+    results = lookup.autocomplete(u'kl', limit=25)
+    assert len(results) == 25
+    assert len(set((result.table, result.row_id) for result in results)) == 25
+    assert len(lookup.autocomplete(u'kl')) == 10
+
+
+def test_autocomplete_cache(lookup):
+    lookup.autocomplete_cache.clear()
+    misses = lookup.autocomplete_cache.misses
+    first = lookup.autocomplete(u'eev')
+    assert lookup.autocomplete_cache.misses == misses + 1
+    # Normalized the same way, so answered from the cache
+    assert lookup.autocomplete(u' Eev') == first
+    assert lookup.autocomplete_cache.misses == misses + 1
+    # Different restrictions are different questions
+    lookup.autocomplete(u'eev', valid_types=['move'])
+    assert lookup.autocomplete_cache.misses == misses + 2
+
+@parametrize(
+    ('name', 'normalized'),
+    [
+        (u'Poké Ball',      u'poke ball'),
+        (u'  Flabébé ',     u'flabebe'),
+        (u'ＥＥＶＥＥ',     u'eevee'),
+        (u'ΣΑΣ',            u'σας'),
+        (u'이브이',         u'이브이'),
+        (u'\u3131\u314f',   u'\uac00'),
+        (u'ポッチャマ',     u'ホッチャマ'),
+    ]
+)
+def test_normalize_name(name, normalized):
+    from pokedex.lookup import normalize_name
+    assert normalize_name(name) == normalized
+    # Again, from the cache this time
+    assert normalize_name(name) == normalized
+
+
+def test_lookup_many(lookup):
+    inputs = [u'Eevee', u'Eeeve', u'eevee', u'item:1', u'pika*', u'@fr:charge',
+              u'xyzzyxyzzy', u'Eevee']
+
+    for valid_types, exact_only in ([], False), (['move'], False), ([], True):
+        expected = [summarize(lookup.lookup(input, valid_types, exact_only))
+                    for input in inputs]
+        found = lookup.lookup_many(inputs, valid_types, exact_only)
+        assert [summarize(results) for results in found] == expected
+
+    assert len(lookup.lookup_many([u'random', u'random'])) == 2
+
+def test_lookup_cache(lookup):
+    from pokedex.lookup import PokedexLookup
+    cached_lookup = PokedexLookup(lookup.directory, session=lookup.session,
+                                  cache_size=16)
+    cache = cached_lookup.lookup_cache
+
+    for input in (u'Eevee', u'Eeeve', u'item:1'):
+        expected = summarize(lookup.lookup(input))
+        assert summarize(cached_lookup.lookup(input)) == expected
+        assert summarize(cached_lookup.lookup(input)) == expected
+    assert cache.stats()['hits'] == 3
+    assert cache.stats()['misses'] == 3
+    cached_lookup.lookup(u'Eevee', exact_only=True)
+    assert cache.misses == 4
@@ -57,3 +57,12 @@ def test_roomaji(kana, roomaji):
 def test_roomaji_cs(kana, roomaji):
     result = pokedex.roomaji.romanize(kana, 'cs')
     assert result == roomaji
+
+
+def test_roomaji_cached():
+    # Each language's answer is remembered separately
+    assert pokedex.roomaji.romanize(u'ニャース') == u'nyaasu'
+    assert pokedex.roomaji.romanize(u'ニャース', 'cs') == u'ňjásu'
+    assert pokedex.roomaji.romanize(u'ニャース') == u'nyaasu'
+    # Unknown languages fall back to English
+    assert pokedex.roomaji.romanize(u'ニャース', 'xx') == u'nyaasu'
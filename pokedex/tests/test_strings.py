@@ -1,5 +1,8 @@
 # Encoding: UTF-8
 
+import gc
+import weakref
+
 import pytest
 parametrize = pytest.mark.parametrize
 
@@ -116,6 +119,71 @@ def test_markdown_string(session):
     assert md.as_html(extension=IdentifierTestExtension(session)) == (
             '<p><a href="move/thunderbolt">Thunderbolt</a> <a href="mechanic/paralysis">paralyzes</a> <a href="form/sky shaymin">Sky Shaymin</a>. <a href="pokemon/mewthree">mewthree</a> does not exist.</p>')
 
+def test_markdown_html_cache(session):
+    en = util.get(session, tables.Language, 'en')
+    source = u'Raises []{type:fire} damage.'
+    markdown.html_cache.clear()
+    stats = markdown.html_cache.stats()
+    html = markdown.MarkdownString(source, session, en).as_html()
+    assert html == u'<p>Raises <span>Fire</span> damage.</p>'
+    assert markdown.html_cache.misses == stats['misses'] + 1
+    # A different string object with the same text comes from the cache
+    assert markdown.MarkdownString(source, session, en).as_html() == html
+    assert markdown.html_cache.hits == stats['hits'] + 1
+
+    # Another extension renders it afresh
+    class LinkingExtension(markdown.PokedexLinkExtension):
+        def identifier_url(self, category, ident):
+            return "%s/%s" % (category, ident)
+    linked = markdown.MarkdownString(source, session, en).as_html(
+        extension=LinkingExtension(session))
+    assert linked == u'<p>Raises <a href="type/fire">Fire</a> damage.</p>'
+    assert markdown.html_cache.misses == stats['misses'] + 2
+
+def test_markdown_html_cache_across_sessions(session):
+    uri = str(session.bind.url)
+    source = u'Raises []{type:fire} damage.'
+    markdown.html_cache.clear()
+    stats = markdown.html_cache.stats()
+
+    def render():
+        new_session = connect(uri)()
+        en = util.get(new_session, tables.Language, 'en')
+        html = markdown.MarkdownString(source, new_session, en).as_html()
+        assert html == u'<p>Raises <span>Fire</span> damage.</p>'
+        new_session.close()
+        return weakref.ref(new_session)
+
+    first_session = render()
+    second_session = render()
+    assert markdown.html_cache.misses == stats['misses'] + 1
+    assert markdown.html_cache.hits == stats['hits'] + 1
+
+    # Neither the cache nor the pooled renderers keep sessions alive
+    gc.collect()
+    assert first_session() is None
+    assert second_session() is None
+
+def test_preload_links(session, count_queries):
+    # A fresh session, that hasn't seen any of these links yet
+    session = connect(str(session.bind.url))
+    en = util.get(session, tables.Language, 'en')
+    strings = [
+        markdown.MarkdownString(u'[]{move:thunderbolt} and []{type:electric}',
+                                session, en),
+        markdown.MarkdownString(u'[]{form:sky shaymin}, []{pokemon:mewthree}',
+                                session, en),
+    ]
+    # One query per table linked to; names come along, other texts don't
+    with count_queries(session.bind) as queries:
+        markdown.preload_links(strings)
+    assert len(queries) == 4
+
+    with count_queries(session.bind) as queries:
+        texts = [md.as_text() for md in strings]
+    assert queries == []
+    assert texts == [u'Thunderbolt and Electric', u'Sky Shaymin, mewthree']
+
 def markdown_column_params():
     """Check all markdown values
 
@@ -47,3 +47,31 @@ def test_get_pokemon_id(session, id):
     result = util.get(session, tables.Pokemon, id=id)
     assert result.id == id
     assert result.__tablename__ == 'pokemon'
+
+def test_lru_cache():
+    from pokedex.util.cache import LRUCache
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # b is now the least recently used, so it goes first
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.clear()
+    assert len(cache) == 0
+
+def test_lru_cache_ttl(monkeypatch):
+    from pokedex.util import cache as cache_module
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now[0])
+    cache = cache_module.LRUCache(ttl=60)
+    cache.put('a', 1)
+    now[0] += 59
+    assert cache.get('a') == 1
+    now[0] += 1
+    assert cache.get('a') is None
+    assert cache.stats() == dict(
+        hits=1, misses=1, hit_rate=0.5, size=0, maxsize=1024)
@@ -0,0 +1,79 @@
+"""A small thread-safe LRU cache
+
+Used to remember lookup results between calls (see `pokedex.lookup`) and
+rendered Markdown (see `pokedex.db.markdown`).
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+_missing = object()
+
+class LRUCache(object):
+    """Maps keys to values, forgetting the least recently used entries once
+    there are more than `maxsize` of them.
+
+    If `ttl` is given, entries also expire that many seconds after they were
+    cached.
+
+    Keeps count of cache hits and misses in `hits` and `misses`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value for `key`, or `default` if it isn't cached."""
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+            if entry is _missing:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                return default
+            # Move it to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Caches `value` under `key`."""
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value, expires
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forgets every entry.  The hit and miss counts are kept."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dict of `hits`, `misses`, `hit_rate` (the fraction of
+        lookups that were hits), `size` and `maxsize`.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=float(self.hits) / lookups if lookups else 0.0,
+                size=len(self._entries),
+                maxsize=self.maxsize,
+            )